@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+
+import numpy as np
+
+# Run from anywhere: the simulation modules live in the repository root
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import main
+import modules.Setup as Setup
+
+def setup_opts():
+    parser = argparse.ArgumentParser(description="Accuracy of float32 runs against the float64 reference")
+    parser.add_argument("--config", type=str, default=os.path.join(ROOT_DIR, "config", "files", "exp_1.cfg"))
+    parser.add_argument("--num_worms", type=int, default=100)
+    parser.add_argument("--sim_args", type=str, default="", help="extra simulation options, e.g. \"--dx 0.005\"")
+    parser.add_argument("--tolerance", type=float, default=1e-3,
+                        help="allowed relative L2 error of the final bacteria map")
+    return parser.parse_args()
+
+def run_precision(opts, precision):
+    # Run the configuration without measurements and return the final state and wall time
+    with tempfile.TemporaryDirectory() as base_dir, open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        cfg = Setup.config_options(["--file", opts.config, "--num_worms", str(opts.num_worms),
+                                    "--base_dir", base_dir, "--precision", precision] + opts.sim_args.split())
+        cfg.verbose = False
+        cfg.measurements_on = False
+        np.random.seed(cfg.random_seed)
+        model_dir = Setup.directories(cfg)
+        world_objects = Setup.world_objects(cfg, Setup.world_parameters(cfg, model_dir))
+        start = time.perf_counter()
+        main.main(cfg, **world_objects)
+        wall_time = time.perf_counter() - start
+
+    environment, worms = world_objects["environment"], world_objects["worms"]
+    return {
+        "bacteria_map": environment.bacteria_map.astype(float),
+        "x": worms.x.astype(float),
+        "y": worms.y.astype(float),
+        "wall_time": wall_time,
+        "nbytes": environment.bacteria_map.nbytes,
+    }
+
+def compare(reference, candidate):
+    # Error measures of a run against the reference
+    error = np.abs(candidate["bacteria_map"] - reference["bacteria_map"])
+    position_error = np.hypot(candidate["x"] - reference["x"], candidate["y"] - reference["y"])
+    return {
+        "relative_l2": np.linalg.norm(error) / np.linalg.norm(reference["bacteria_map"]),
+        "max_abs": error.max(),
+        "cells_off_1e-4": np.mean(error > 1e-4),
+        "worm_position_median": np.median(position_error),
+        "worm_position_max": position_error.max(),
+    }
+
+if __name__ == '__main__':
+    opts = setup_opts()
+    reference = run_precision(opts, "float64")
+    candidate = run_precision(opts, "float32")
+    errors = compare(reference, candidate)
+
+    print(f"Config: {opts.config} (N={opts.num_worms}) {opts.sim_args}")
+    print(f"{'precision':<10} {'wall time [s]':>14} {'grid [MB]':>10}")
+    for precision, result in (("float64", reference), ("float32", candidate)):
+        print(f"{precision:<10} {result['wall_time']:>14.3f} {result['nbytes'] / 2**20:>10.2f}")
+    for key, val in errors.items():
+        print(f"{key:<22} {val:.3e}")
+
+    if errors["relative_l2"] > opts.tolerance:
+        print(f"FAILED: relative L2 error {errors['relative_l2']:.3e} exceeds {opts.tolerance:.1e}")
+        sys.exit(1)
+    print("OK")
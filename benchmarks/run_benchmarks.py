@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import multiprocessing
+from itertools import product
+
+import numpy as np
+
+# Run from anywhere: the simulation modules live in the repository root
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import main
+import modules.Setup as Setup
+import modules.Stencil as Stencil
+import modules.Profiler as Profiler
+import modules.Estimator as Estimator
+
+def setup_opts():
+    parser = argparse.ArgumentParser(description="Headless scaling benchmarks of the simulation core")
+    parser.add_argument("--num_worms", type=int, nargs="+", default=[1, 100, 1000])
+    parser.add_argument("--dx", type=float, nargs="+", default=[0.02, 0.01])
+    parser.add_argument("--steps", type=int, nargs="+", default=[100])
+    parser.add_argument("--measurements", type=str, nargs="+", default=["on", "off"], choices=["on", "off"])
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per case, the fastest is reported")
+    parser.add_argument("--sim_args", type=str, default="", help="extra simulation options, e.g. \"--pde_solver imex\"")
+    parser.add_argument("-o", "--output", type=str, default="benchmark_results.json")
+    parser.add_argument("--compare", type=str, default=None, help="baseline JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed relative slowdown / memory growth")
+    return parser.parse_args()
+
+def case_key(case):
+    # Identifies a case across result files
+    return (case["num_worms"], case["dx"], case["steps"], case["measurements"])
+
+def build_world(case, sim_args, base_dir):
+    # Parse the defaults plus the case overrides and build the world in a scratch directory
+    cfg = Setup.config_options(sim_args + [
+        "--num_worms", str(case["num_worms"]),
+        "--dx", str(case["dx"]),
+        "--base_dir", base_dir,
+    ])
+    cfg.verbose = False
+    cfg.measurements_on = case["measurements"] == "on"
+    # Fix the number of worm steps rather than the end time
+    worm_dt = cfg.worm_dt if cfg.worm_dt > 0 else cfg.dt
+    cfg.t_max = cfg.t_min + (case["steps"] - 0.5) * worm_dt
+
+    np.random.seed(cfg.random_seed)
+    model_dir = Setup.directories(cfg)
+    world_params = Setup.world_parameters(cfg, model_dir)
+    return cfg, Setup.world_objects(cfg, world_params)
+
+def time_case(case, sim_args):
+    # Run one case in this process and return the fastest wall time of the main loop
+    timings, world_objects = Profiler.time_runs(lambda base_dir, _: build_world(case, sim_args, base_dir),
+                                                main.main, range(case["repeats"] + 1))
+    environment = world_objects["environment"]
+    wall_time = min(timings)
+    num_steps = environment.t_grid.shape[0]
+    num_cells = int(np.prod(environment.grid_shape))
+    pde_steps = num_steps * environment.pde_substeps * environment.num_replicates
+
+    return {
+        **case,
+        "wall_time_s": wall_time,
+        "num_steps": num_steps,
+        "grid_shape": list(environment.grid_shape),
+        "steps_per_s": num_steps / wall_time,
+        "worm_steps_per_s": num_steps * case["num_worms"] * environment.num_replicates / wall_time,
+        "cells_per_s": pde_steps * num_cells / wall_time,
+        "peak_rss_bytes": Estimator.peak_rss_bytes(),
+    }
+
+def run_case(task):
+    return time_case(*task)
+
+def machine_info():
+    # Enough context to tell whether two result files are comparable
+    return {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": Stencil.numba.__version__ if Stencil.numba is not None else None,
+    }
+
+def run_benchmarks(opts):
+    cases = [
+        {"num_worms": num_worms, "dx": dx, "steps": steps, "measurements": measurements, "repeats": opts.repeats}
+        for num_worms, dx, steps, measurements in product(opts.num_worms, opts.dx, opts.steps, opts.measurements)
+    ]
+    sim_args = opts.sim_args.split()
+
+    # A fresh process per case keeps the peak memory of one case from leaking into the next
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for case_i, case in enumerate(cases):
+        with context.Pool(1) as pool:
+            result = pool.apply(run_case, ((case, sim_args),))
+        results.append(result)
+        print(f"[{case_i+1}/{len(cases)}] N={case['num_worms']:<6} dx={case['dx']:<7} "
+              f"steps={case['steps']:<6} measurements={case['measurements']:<4} "
+              f"{result['steps_per_s']:>10.1f} steps/s {result['worm_steps_per_s']:>12.0f} worm-steps/s "
+              f"{result['cells_per_s']:>12.3g} cells/s {result['peak_rss_bytes'] / 2**20:>8.1f} MB")
+
+    return {"machine": machine_info(), "sim_args": sim_args, "results": results}
+
+def compare(results, baseline, threshold):
+    # Regressions: throughput below (1 - threshold) or peak memory above (1 + threshold) of the baseline
+    baseline_cases = {case_key(case): case for case in baseline["results"]}
+    regressions = []
+    for case in results["results"]:
+        base = baseline_cases.get(case_key(case))
+        if base is None:
+            continue
+        speed = case["steps_per_s"] / base["steps_per_s"]
+        memory = case["peak_rss_bytes"] / base["peak_rss_bytes"]
+        flag = ""
+        if speed < 1 - threshold or memory > 1 + threshold:
+            regressions.append(case)
+            flag = "  ** REGRESSION"
+        print(f"N={case['num_worms']:<6} dx={case['dx']:<7} steps={case['steps']:<6} "
+              f"measurements={case['measurements']:<4} speed x{speed:.2f}  memory x{memory:.2f}{flag}")
+    return regressions
+
+if __name__ == '__main__':
+    opts = setup_opts()
+
+    results = run_benchmarks(opts)
+    with open(opts.output, "w") as outfile:
+        json.dump(results, outfile, indent=2)
+    print(f"Results written to {opts.output}")
+
+    if opts.compare:
+        with open(opts.compare) as infile:
+            baseline = json.load(infile)
+        print(f"\nComparison against {opts.compare} (threshold {opts.threshold:.0%})")
+        regressions = compare(results, baseline, opts.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} case(s) regressed")
+            sys.exit(1)
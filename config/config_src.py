@@ -2,6 +2,7 @@ config_opts = {
     # Simulation parameters
     "verbose"     : True,
     "random_seed" : 42,
+    "worm_rng" : "legacy",
 
     # Environment parameters
     "x_min" : -1.5,
@@ -10,9 +11,19 @@ config_opts = {
     "t_min" : 0,
     "t_max" : 0.0025,
     "dt" : 0.000025,
+    "worm_dt" : 0,
+    "pde_solver" : "euler",
+    "pde_backend" : "auto",
+    "active_tile_size" : 32,
+    "pde_processes" : 1,
+    "pde_threads" : 1,
+    "precision" : "float64",
 
     # Worm parameters
     "num_worms" : 1,
+    "worm_init" : "lattice",
+    "worm_min_dist" : 0.0,
+    "worm_clusters" : 4,
     "worm_step_size" : 0.1,
     "worm_turn_noise" : 0.2,
     "worm_mean_run_duration" : 3,
@@ -23,6 +34,12 @@ config_opts = {
 
     # Other parameters
     "measurements_on" : True,
+    "flush_every" : 50,
+    "checkpoint_every" : 0,
+    "snapshot_interval" : 1,
+    "snapshot_downsample" : 1,
+    "snapshot_dtype" : "float64",
+    "compression" : "none",
 }
 
 
@@ -3,54 +3,119 @@ import warnings
 
 warnings.filterwarnings("ignore")
 
+import os
+import sys
 import modules.Setup as Setup
+import modules.Checkpoint as Checkpoint
+import modules.Cache as Cache
+import modules.Estimator as Estimator
 
-def main(cfg_options, environment, worms, keeper):
+def main(cfg_options, environment, worms, keeper, profiler, start_i=0, checkpoint_path=None):
     
     print("Begin simulation")
     
+    num_steps = 0
+    interrupted = False
     try:
-        for global_i, t_i in enumerate(environment):
+        for global_i in range(start_i, environment.t_grid.shape[0]):
             
             if cfg_options.verbose:
                 print(f"\rTimestep: {global_i+1}/{environment.t_grid.shape[0]}")
 
-            # Initialize or update bacteria map
-            environment.update_bacteria_map()
+            # Update bacteria map, sub-cycling PDE steps up to the next worm step
+            with profiler.phase("environment.update_bacteria_map"):
+                environment.update_bacteria_map()
 
-            for worm in worms:
-                worm.step(environment)
+            # Advance all worms at once
+            with profiler.phase("worms.step"):
+                worms.step(environment)
 
-                # Measure and store worm info
-                keeper.measure_worms(worm, global_i)
+            # Measure and store worm info
+            with profiler.phase("keeper.measure_worms"):
+                keeper.measure_worms(worms, global_i)
 
             # Store environment info after all worms have moved
-            keeper.measure_environment(environment)
+            with profiler.phase("keeper.measure_environment"):
+                keeper.measure_environment(environment, global_i)
+            profiler.sample_bytes("keeper.buffers", keeper.buffer_nbytes())
+
+            # Periodically save everything needed to resume after this timestep
+            if cfg_options.checkpoint_every and (global_i + 1) % cfg_options.checkpoint_every == 0:
+                with profiler.phase("checkpoint"):
+                    Checkpoint.save(checkpoint_path, global_i + 1, environment, worms, keeper)
+            num_steps += 1
         
         # Save data to h5 files
-        keeper.log_data_to_handy_dandy_notebook()
+        with profiler.phase("keeper.log_data"):
+            keeper.log_data_to_handy_dandy_notebook()
     
     except KeyboardInterrupt:
         print("\nEnding early.")
         keeper.log_data_to_handy_dandy_notebook()
+        interrupted = True
 
-if __name__ == '__main__':
+    return num_steps, interrupted
+
+def run(argv=None):
+    # Returns the experiment directory and whether the run was interrupted (Ctrl-C)
     # Parse configuration
-    cfg_options = Setup.config_options()
+    cfg_options = Setup.config_options(argv)
+
+    # Check the expected peak memory against the budget, decimating measurements if allowed
+    if cfg_options.max_memory is not None:
+        try:
+            _, changes = Estimator.enforce_budget(cfg_options, cfg_options.max_memory, cfg_options.memory_policy)
+        except ValueError as error:
+            # Refused runs exit with the reason instead of a traceback
+            sys.exit(f"Not running: {error}")
+        if changes:
+            print(f"Decimated to fit --max_memory: {', '.join(changes)}")
+
+    # Report the expected footprint and runtime without running
+    if cfg_options.dry_run:
+        print(Estimator.report(Estimator.estimate(cfg_options), Estimator.calibrate(cfg_options, main)))
+        return None, False
+
     np.random.seed(cfg_options.random_seed)
 
-    # Create experiment directory
-    model_dir = Setup.directory(cfg_options)
+    # Create experiment directory (one per replicate in ensemble mode)
+    model_dir = Setup.directories(cfg_options)
     print(f"Experiment directory: {model_dir}")
 
+    # Complete results of the same config and code are reused
+    if Cache.is_complete(model_dir) and not cfg_options.force:
+        print("Results of this configuration are complete, skipping (--force recomputes)")
+        return model_dir, False
+    Cache.clear(model_dir)
+
     # Organize parameters
     world_params = Setup.world_parameters(cfg_options, model_dir)
 
     # Instantiate world objects
     world_objects = Setup.world_objects(cfg_options, world_params)
+
+    # Continue from the last checkpoint if there is one
+    checkpoint_path = Checkpoint.checkpoint_path(model_dir)
+    start_i = 0
+    if cfg_options.resume and os.path.exists(checkpoint_path):
+        start_i = Checkpoint.load(checkpoint_path, world_objects["environment"],
+                                  world_objects["worms"], world_objects["keeper"])
+        print(f"Resuming from timestep {start_i+1}")
     
     # Run simulation
-    main(cfg_options, **world_objects)           
+    num_steps, interrupted = main(cfg_options, **world_objects, start_i=start_i, checkpoint_path=checkpoint_path)
+
+    # Per-phase timing report (only with --profile)
+    world_objects["profiler"].write_report(model_dir, num_steps)
+
+    # Runs that reached the end are marked complete and added to the cache index
+    if start_i + num_steps == world_objects["environment"].t_grid.shape[0]:
+        Cache.mark_complete(model_dir, cfg_options, Setup.replicate_seeds(cfg_options))
+
+    return model_dir, interrupted
+
+if __name__ == '__main__':
+    run()
 
 
 
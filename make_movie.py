@@ -3,17 +3,22 @@ import time
 import cv2
 import sys
 import glob2
-import h5py
 import shutil
 import argparse
+import multiprocessing
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
+import modules.Reader as Reader
+
 import warnings
 warnings.filterwarnings("ignore")
 
+# Most frames read and rendered per chunk, so memory stays bounded for long histories
+CHUNK_FRAMES = 32
+
 def read_config(base_exp_dir):
     """Read configuration options from .cfg file in experiment directory"""
     cfg_paths = glob2.glob(f"{base_exp_dir}/*.cfg")
@@ -57,51 +62,49 @@ def imgs2vid(imgs, outpath, fps=15):
     cv2.destroyAllWindows()
     video.release()
 
-def process_data(env_path, worm_path):
-    """Process worm and bacteria data from HDF5 files"""
-    # Load bacteria time series (3D array)
-    bacteria_history = []
-    with h5py.File(env_path, 'r') as infile:
-        if 'bacteria' in infile:
-            bacteria_history = np.array(infile['bacteria'])
-
-    # Get worm measurements
-    worm_data = {}
-    with h5py.File(worm_path, 'r') as infile:
-        for key, val in infile.items():
-            worm_data[key] = np.array(val)
-    worm_nums = np.unique(worm_data['worm_i'])
-    worms = {}
-    for worm_num in worm_nums:
-        idxs = np.where(worm_data['worm_i']==worm_num)
-        worm_x = worm_data['x'][idxs]
-        worm_y = worm_data['y'][idxs]
-        worms[worm_num] = {"x" : worm_x, "y" : worm_y,}
-
-    return worms, bacteria_history
-
-def plot_frame(frame_i, worms, bacteria_history, legend_colors, texts, script_config, convert_xy_to_index, total_frames):  
+def process_data(reader):
+    """Display settings of the bacteria heatmap, with the colour scale of the whole history"""
+    if not reader.has_bacteria:
+        return {}
+    min_b, max_b = reader.bacteria_range()
+    return {"extent": reader.extent, "grid_shape": reader.grid_shape, "vmin": min_b, "vmax": max_b * 0.85}
+
+def read_frames(reader, frames):
+    """Read only the worm records and bacteria snapshots shown in the given frames"""
+    worm_data = reader.worm_frames_at(frames)
+
+    bacteria_grids = None
+    if reader.has_bacteria:
+        bacteria_grids = reader.bacteria_snapshots(reader.frame_snapshots[frames])
+
+    for frame_j, frame_i in enumerate(frames):
+        grid = None if bacteria_grids is None else bacteria_grids[frame_j]
+        yield frame_i, worm_data['x'][frame_j], worm_data['y'][frame_j], grid
+
+def index_converter(script_config):
+    """Map real coordinates to grid index space"""
+    X_MIN = script_config['x_min']
+    X_MAX = script_config['x_max']
+    DX = script_config['dx']
+    GRID_SIZE = np.arange(X_MIN, X_MAX+DX, DX).shape[0]
+    return lambda xy: ((xy - X_MIN) / (X_MAX - X_MIN)) * GRID_SIZE
+
+def plot_frame(frame_i, worm_x, worm_y, bacteria_grid, bacteria, legend_colors, texts, script_config,
+               convert_xy_to_index, total_frames, frame_path):
     """Plot a single frame of the simulation including worms and bacteria concentration"""
     # Plot bacteria concentration map with gradient
-    if len(bacteria_history) > frame_i:
-        bacteria_grid = bacteria_history[frame_i]
-        
-        # Get min/max for color scaling
-        min_b = np.min(bacteria_history)
-        max_b = np.max(bacteria_history) * 0.85
-        
-        # Display bacteria as heatmap 
-        im = plt.imshow(bacteria_grid, cmap='Greens', vmin=min_b, vmax=max_b, 
-                        origin='upper', alpha=0.8, interpolation='bilinear')
+    if bacteria_grid is not None:
+        # Display bacteria as heatmap, on the colour scale of the whole history
+        im = plt.imshow(bacteria_grid, cmap='Greens', vmin=bacteria["vmin"], vmax=bacteria["vmax"], 
+                        origin='upper', alpha=0.8, interpolation='bilinear',
+                        extent=bacteria["extent"])
         
         # Add colorbar to show concentration scale
         clb = plt.colorbar(im, shrink=0.8, format='%.2f')
         clb.ax.set_title('Bacteria\nConc.')
 
     # Process worm data
-    for worm_key, worm_vals in worms.items():
-        x = worm_vals['x'][frame_i]
-        y = worm_vals['y'][frame_i]
+    for x, y in zip(worm_x, worm_y):
         color = 'Gray'
         plt.scatter(convert_xy_to_index(x), convert_xy_to_index(y),
                     color=color, s=100, edgecolors='black', zorder = 10)
@@ -117,7 +120,7 @@ def plot_frame(frame_i, worms, bacteria_history, legend_colors, texts, script_co
     plt.ylabel("Y")    
     
     # Set axes to INDEX SPACE
-    GRID_SIZE = bacteria_grid.shape[0]
+    GRID_SIZE = bacteria["grid_shape"][0] if bacteria else convert_xy_to_index(script_config['x_max'])
     plt.xlim(0, GRID_SIZE)
     plt.ylim(0, GRID_SIZE)
 
@@ -129,51 +132,161 @@ def plot_frame(frame_i, worms, bacteria_history, legend_colors, texts, script_co
 
     # Save frames
     file_path = f't{frame_i+1:03d}.png'
-    filename = f'{MOVIE_FRAME_PATH}/{file_path}'
+    filename = f'{frame_path}/{file_path}'
     plt.savefig(filename, bbox_inches='tight', dpi=150)
     plt.close()
 
+def render_frames(task):
+    """Render a contiguous range of frames; runs in a worker process when -j > 1"""
+    reader, frame_path, frames, script_config, bacteria = task
+    convert_xy_to_index = index_converter(script_config)
+    texts = ['Worm', 'Bacteria']
+    legend_colors = ['Gray', 'Green']
+
+    with reader:
+        for frame_i, worm_x, worm_y, bacteria_grid in read_frames(reader, frames):
+            plot_frame(frame_i, worm_x, worm_y, bacteria_grid, bacteria, legend_colors, texts, script_config,
+                       convert_xy_to_index, reader.num_frames, frame_path)
+    return len(frames)
+
+class StreamingFrame(object):
+    """
+        Reusable movie figure
+        ---------------------
+        Builds the figure, heatmap, colorbar, worm markers and legend once
+        with the same styling as `plot_frame`. Every frame only swaps the
+        heatmap data, the marker offsets and the title, then renders the
+        canvas into a BGR array for `cv2.VideoWriter`.
+    """
+    def __init__(self, bacteria, num_worms, legend_colors, texts, script_config, convert_xy_to_index, total_frames):
+        self.convert_xy_to_index = convert_xy_to_index
+        self.total_frames = total_frames
+        N = script_config['num_worms']
+        seed = int(script_config['random_seed'])
+        self.title = f"Number of worms: {int(N)} -- Random seed: {seed}"
+
+        self.fig, self.ax = plt.subplots(dpi=150)
+        self.im = None
+        if bacteria:
+            # Colour limits of the whole history are fixed for the movie
+            self.im = self.ax.imshow(np.zeros((1, 1)), cmap='Greens', vmin=bacteria["vmin"], vmax=bacteria["vmax"],
+                                     origin='upper', alpha=0.8, interpolation='bilinear',
+                                     extent=bacteria["extent"])
+            clb = self.fig.colorbar(self.im, ax=self.ax, shrink=0.8, format='%.2f')
+            clb.ax.set_title('Bacteria\nConc.')
+
+        self.worms = self.ax.scatter(np.zeros(num_worms), np.zeros(num_worms),
+                                     color='Gray', s=100, edgecolors='black', zorder = 10)
+
+        patches = [ self.ax.plot([],[], marker="o", ms=10 if color_i==0 else 6, ls="", color=legend_colors[color_i],
+                    markeredgecolor="black", label="{:s}".format(texts[color_i]) )[0]  for color_i in range(len(texts)) ]
+        self.ax.legend(handles=patches, bbox_to_anchor=(0.5, -0.15),
+                       loc='center', ncol=4, numpoints=1, labelspacing=0.3,
+                       fontsize='small', fancybox="True",
+                       handletextpad=0, columnspacing=0)
+        self.ax.set_xlabel("X")
+        self.ax.set_ylabel("Y")
+
+        # Set axes to INDEX SPACE
+        GRID_SIZE = bacteria["grid_shape"][0] if bacteria else convert_xy_to_index(script_config['x_max'])
+        self.ax.set_xlim(0, GRID_SIZE)
+        self.ax.set_ylim(0, GRID_SIZE)
+        self.title_text = self.ax.set_title(f"{self.title} \n t: {total_frames}/{total_frames}")
+
+        # Lay out once with the widest title so every frame has the same size
+        self.fig.tight_layout()
+        self.size = self.fig.canvas.get_width_height()
+
+    def render(self, frame_i, worm_x, worm_y, bacteria_grid):
+        """Update the artists for one frame and return it as a BGR image"""
+        if self.im is not None:
+            self.im.set_data(bacteria_grid)
+        self.worms.set_offsets(np.column_stack((self.convert_xy_to_index(worm_x), self.convert_xy_to_index(worm_y))))
+        self.title_text.set_text(f"{self.title} \n t: {frame_i+1}/{self.total_frames}")
+
+        self.fig.canvas.draw()
+        return cv2.cvtColor(np.asarray(self.fig.canvas.buffer_rgba()), cv2.COLOR_RGBA2BGR)
+
+    def close(self):
+        plt.close(self.fig)
+
+def stream_movie(reader, savepath, fps, frames, script_config, bacteria, chunk_size=CHUNK_FRAMES):
+    """Render frames straight into the video, reading the data chunk by chunk"""
+    figure = StreamingFrame(bacteria, reader.num_worms, ['Gray', 'Green'], ['Worm', 'Bacteria'], script_config,
+                            index_converter(script_config), reader.num_frames)
+    fourcc = cv2.VideoWriter_fourcc("m", "p", "4", "v")
+    video = cv2.VideoWriter(savepath, fourcc, fps, figure.size, True)
+
+    num_done = 0
+    try:
+        for start in range(0, len(frames), chunk_size):
+            for frame in read_frames(reader, frames[start:start + chunk_size]):
+                video.write(figure.render(*frame))
+                num_done += 1
+                sys.stdout.write(f"\rMaking frame {num_done}/{len(frames)}")
+                sys.stdout.flush()
+    finally:
+        video.release()
+        figure.close()
+
+def frame_chunks(frames, jobs, chunks_per_job=4, max_frames=CHUNK_FRAMES):
+    """Split frames into contiguous ranges, a few per worker so the load stays balanced, of at most max_frames"""
+    num_chunks = max(1, min(len(frames), max(jobs * chunks_per_job, -(-len(frames) // max_frames))))
+    return [chunk for chunk in np.array_split(frames, num_chunks) if len(chunk) > 0]
+
 def setup_opts():
     """Setup command line options for the script"""
     parser = argparse.ArgumentParser()
-    parser.add_argument('-p', '--path', type=str, default='N1_seed42', help='Path to experiment folder')
+    parser.add_argument('-p', '--path', type=str, required=True, help='Experiment folder in experiments/, e.g. N1_seed42_<hash>')
     parser.add_argument('-r', '--fps', type=int, default=5, help='FPS for output movie')
     parser.add_argument('-s', '--stepsize', type=int, default=1, help='Step size for plotting data')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes rendering frames')
+    parser.add_argument('--stream', action='store_true', help='Encode frames directly without writing PNGs')
     return parser.parse_args()
 
-def main(exp_path, fps, stepsize):
+def main(exp_path, fps, stepsize, jobs=1, stream=False):
     """Main function to generate movie frames and compile them into a video"""
     # Obtain parameters from config
     script_config = read_config(exp_path)
-    X_MIN = script_config['x_min']
-    X_MAX = script_config['x_max']
-    DX = script_config['dx']
-    GRID_SIZE = np.arange(X_MIN, X_MAX+DX, DX).shape[0]
-    convert_xy_to_index = lambda xy: ((xy - X_MIN) / (X_MAX - X_MIN)) * GRID_SIZE
+    frame_path = os.path.join(exp_path, "movie_frames")
+
+    # Index the data and compute colour limits once; workers read their own frames
+    with Reader.ExperimentReader(exp_path) as reader:
+        bacteria = process_data(reader)
+    frames = np.arange(0, reader.num_frames, stepsize)
+    trial_name = os.path.basename(os.path.normpath(exp_path))  # Just the folder name, e.g. 'N1_seed42_<hash>'
+    savepath = os.path.join(exp_path, f"{trial_name}.mp4")
 
-    # Get data path
-    worm_path = os.path.join(exp_path, "worm_hist.h5")
-    env_path = os.path.join(exp_path, "environment_hist.h5")
+    # Single figure rendered straight into the video, memory independent of the number of frames
+    if stream:
+        with reader:
+            stream_movie(reader, savepath, fps, frames, script_config, bacteria)
+        return
 
-    # Obtain & process data
-    worms, bacteria_sources = process_data(env_path, worm_path)
+    tasks = [(reader, frame_path, chunk, script_config, bacteria)
+             for chunk in frame_chunks(frames, jobs)]
 
-    # Setup for plotting
-    total_frames = len(list(worms.values())[0]['x'])
-    texts = ['Worm', 'Bacteria']
-    legend_colors = ['Gray', 'Green']
+    if jobs <= 1:
+        results = map(render_frames, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(render_frames, tasks)
 
-    for frame_i in range(0, total_frames, stepsize):
-            sys.stdout.write(f"\rMaking frame {frame_i+1}/{total_frames}")
+    num_done = 0
+    try:
+        for num_rendered in results:
+            num_done += num_rendered
+            sys.stdout.write(f"\rMaking frame {num_done}/{len(frames)}")
             sys.stdout.flush()
-
-            plot_frame(frame_i, worms, bacteria_sources, legend_colors, texts, script_config, convert_xy_to_index, total_frames)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     
-    # Stitching frames together to create video
-    all_img_paths = np.sort(glob2.glob(f"{MOVIE_FRAME_PATH}/*.png"))
+    # Stitching frames together, in frame order, to create video
+    all_img_paths = np.sort(glob2.glob(f"{frame_path}/*.png"))
     all_imgs = np.array([cv2.imread(img) for img in all_img_paths])
-    trial_name = os.path.basename(exp_path)  # Extract just 'N1_seed42'
-    savepath = os.path.join(exp_path, f"{trial_name}.mp4")
     imgs2vid(all_imgs, savepath, fps)
 
 if __name__ == '__main__':
@@ -184,7 +297,8 @@ if __name__ == '__main__':
     MOVIE_FRAME_PATH = f"{BASE_EXPERIMENT_DIR}/movie_frames"
     if os.path.exists(MOVIE_FRAME_PATH):
         shutil.rmtree(MOVIE_FRAME_PATH)
-    os.makedirs(MOVIE_FRAME_PATH, exist_ok=True)
+    if not opts.stream:
+        os.makedirs(MOVIE_FRAME_PATH, exist_ok=True)
     print(BASE_EXPERIMENT_DIR)
     print(TRIAL_PATH)
 
@@ -193,5 +307,5 @@ if __name__ == '__main__':
     INTERVAL = opts.stepsize
 
     print("\n---------- Visualizing worm model data ----------")
-    main(BASE_EXPERIMENT_DIR, FPS, INTERVAL)
+    main(BASE_EXPERIMENT_DIR, FPS, INTERVAL, opts.jobs, opts.stream)
     print("\nDone!\n")
\ No newline at end of file
@@ -0,0 +1,120 @@
+import os
+import glob
+import json
+import hashlib
+import functools
+from datetime import datetime
+
+MARKER_NAME = "complete.json"
+INDEX_NAME = "cache_index.json"
+HASH_LENGTH = 12
+
+# Options that cannot change the results of a run: where and how verbosely it runs,
+# how the PDE is parallelised and how often state is flushed or checkpointed
+IGNORED_OPTIONS = {
+    "verbose", "resume", "profile", "force", "dry_run", "max_memory", "memory_policy", "file", "config_file", "base_dir",
+    "flush_every", "checkpoint_every", "active_tile_size", "pde_processes", "pde_threads",
+}
+
+# Simulation sources whose contents make up the code version
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CODE_FILES = ["main.py", os.path.join("modules", "*.py")]
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+    # Content hash of the simulation sources, so any code change invalidates cached results
+    digest = hashlib.sha256()
+    paths = sorted(path for pattern in CODE_FILES for path in glob.glob(os.path.join(ROOT_DIR, pattern)))
+    for path in paths:
+        digest.update(os.path.relpath(path, ROOT_DIR).encode())
+        with open(path, "rb") as infile:
+            digest.update(infile.read())
+    return digest.hexdigest()[:HASH_LENGTH]
+
+def resolved_config(config, seed=None):
+    # Options that determine the results; a replicate is keyed like a single run with its seed
+    resolved = {key: val for key, val in sorted(vars(config).items()) if key not in IGNORED_OPTIONS}
+    if seed is not None:
+        resolved["random_seed"] = seed
+        resolved["num_replicates"] = 1
+    return resolved
+
+def config_hash(config, seed=None):
+    # Canonical hash of the resolved configuration and the code version
+    key = json.dumps({"config": resolved_config(config, seed), "code_version": code_version()}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()[:HASH_LENGTH]
+
+def _write_json(path, data):
+    # Replace atomically; the temporary name is per process so concurrent writers do not collide
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as outfile:
+        json.dump(data, outfile, indent=2)
+    os.replace(tmp_path, path)
+
+def _model_dirs(model_dir):
+    return model_dir if isinstance(model_dir, list) else [model_dir]
+
+def is_complete(model_dir):
+    # A run is complete once every one of its directories holds a completion marker
+    return all(os.path.exists(os.path.join(path, MARKER_NAME)) for path in _model_dirs(model_dir))
+
+def clear(model_dir):
+    # Drop completion markers before (re)computing, so an interrupted run is never reused
+    for path in _model_dirs(model_dir):
+        marker_path = os.path.join(path, MARKER_NAME)
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+
+def mark_complete(model_dir, config, seeds):
+    # Write the completion marker of every replicate directory and add them to the cache index
+    entries = {}
+    for path, seed in zip(_model_dirs(model_dir), seeds):
+        marker = {
+            "config_hash": config_hash(config, seed),
+            "code_version": code_version(),
+            "config": resolved_config(config, seed),
+            "completed": datetime.now().isoformat(timespec="seconds"),
+        }
+        _write_json(os.path.join(path, MARKER_NAME), marker)
+        entries[marker["config_hash"]] = _index_entry(path, marker)
+    add_to_index(config.base_dir, entries)
+
+def _index_entry(path, marker):
+    return {"model_dir": os.path.basename(path), "code_version": marker["code_version"],
+            "completed": marker["completed"], "config": marker["config"]}
+
+def read_index(base_dir):
+    # Cached runs of a base directory by config hash
+    path = os.path.join(base_dir, INDEX_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as infile:
+        return json.load(infile)
+
+def add_to_index(base_dir, entries):
+    # Merge entries into the index; lost updates of concurrent writers are repaired by rebuild_index
+    index = read_index(base_dir)
+    index.update(entries)
+    _write_json(os.path.join(base_dir, INDEX_NAME), index)
+
+def rebuild_index(base_dir):
+    # Recreate the index from the completion markers on disk and return it
+    index = {}
+    for marker_path in sorted(glob.glob(os.path.join(base_dir, "*", MARKER_NAME))):
+        with open(marker_path) as infile:
+            marker = json.load(infile)
+        index[marker["config_hash"]] = _index_entry(os.path.dirname(marker_path), marker)
+    os.makedirs(base_dir, exist_ok=True)
+    _write_json(os.path.join(base_dir, INDEX_NAME), index)
+    return index
+
+def lookup(index, config, seeds):
+    # Cached directories of a run (one per replicate), or None if any replicate must be computed
+    model_dirs = []
+    for seed in seeds:
+        entry = index.get(config_hash(config, seed))
+        path = None if entry is None else os.path.join(config.base_dir, entry["model_dir"])
+        if path is None or not is_complete(path):
+            return None
+        model_dirs.append(path)
+    return model_dirs[0] if len(model_dirs) == 1 else model_dirs
@@ -0,0 +1,33 @@
+import os
+import numpy as np
+
+CHECKPOINT_NAME = "checkpoint.npz"
+
+def checkpoint_path(model_dir):
+    # Checkpoint file of a run; an ensemble keeps it in its first replicate's directory
+    if isinstance(model_dir, list):
+        model_dir = model_dir[0]
+    return os.path.join(model_dir, CHECKPOINT_NAME)
+
+def save(path, next_i, environment, worms, keeper):
+    # Write the full simulation state atomically, so a crash mid-write keeps the previous checkpoint
+    arrays = {"next_i": np.array(next_i)}
+    for prefix, obj in (("environment", environment), ("worms", worms), ("keeper", keeper)):
+        for key, val in obj.checkpoint_state().items():
+            arrays[f"{prefix}.{key}"] = val
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as outfile:
+        np.savez(outfile, **arrays)
+    os.replace(tmp_path, path)
+
+def load(path, environment, worms, keeper):
+    # Restore the simulation state and return the index of the next timestep to run
+    with np.load(path) as infile:
+        arrays = {key: infile[key] for key in infile.files}
+
+    for prefix, obj in (("environment", environment), ("worms", worms), ("keeper", keeper)):
+        state = {key[len(prefix) + 1:]: val for key, val in arrays.items() if key.startswith(f"{prefix}.")}
+        obj.restore_state(state)
+
+    return int(arrays["next_i"])
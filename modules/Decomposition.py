@@ -0,0 +1,165 @@
+import signal
+import weakref
+import threading
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import modules.Stencil as Stencil
+
+# Commands broadcast to the strip workers
+STEP = 1
+STOP = 0
+# Seconds the parent waits at a step barrier before declaring the workers hung
+STEP_TIMEOUT = 600
+
+def strip_bounds(height, processes):
+    """Split rows [0, height) into at most `processes` contiguous strips of near-equal size"""
+    edges = np.linspace(0, height, min(processes, height) + 1).round().astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+def strip_worker(shm_name, shape, dtype, start, stop, dx, dt, backend, threads, barrier, command):
+    """Update rows [start, stop) of the shared grid on every STEP until STOP"""
+    # The parent handles interrupts and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    field = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    # Owned rows plus one halo row on each inner side, read straight from the shared grid;
+    # at the grid edges there is no halo and the edge rows stay boundary rows
+    halo_start, halo_stop = max(start - 1, 0), min(stop + 1, shape[-2])
+    strip = field[..., halo_start:halo_stop, :]
+    blocks = [(slice(start - halo_start, stop - halo_start), slice(0, shape[-1]))]
+    try:
+        engine = Stencil.StencilEngine(dx, dt, backend, threads)
+        while True:
+            barrier.wait()
+            if command.value == STOP:
+                break
+            # Every strip reads its halo before any strip writes its rows back
+            engine.compute(strip, blocks)
+            barrier.wait()
+            engine.apply(strip, blocks)
+            barrier.wait()
+    except threading.BrokenBarrierError:
+        # Another strip or the parent gave up; the failure is reported there
+        return
+    except BaseException:
+        # Break the barrier so the parent and the other strips do not wait forever
+        barrier.abort()
+        raise
+
+    del field, strip
+    shm.close()
+
+def watch_workers(workers, barrier):
+    """Break the barrier as soon as a worker exits with an error (e.g. killed), so nobody waits on it"""
+    pending = {worker.sentinel: worker for worker in workers}
+    while pending:
+        for sentinel in multiprocessing.connection.wait(list(pending)):
+            if pending.pop(sentinel).exitcode != 0:
+                barrier.abort()
+
+def release(workers, barrier, command, shm):
+    """Stop the workers and free the shared grid"""
+    if any(worker.is_alive() for worker in workers):
+        command.value = STOP
+        try:
+            barrier.wait(timeout=10)
+        except Exception:
+            pass
+    for worker in workers:
+        worker.join(timeout=10)
+        if worker.is_alive():
+            worker.terminate()
+    shm.close()
+    shm.unlink()
+
+
+class StripEuler(object):
+    """
+        Forward Euler over row strips in worker processes
+        -------------------------------------------------
+        The bacteria grid lives in shared memory and is split into
+        contiguous row strips, one per worker process. Each worker runs its
+        own StencilEngine on its strip and reads the one-row halo of its
+        neighbours directly from the shared grid. Barriers separate the
+        compute phase (everyone reads the old grid) from the apply phase
+        (everyone writes its own rows), so results are identical to the
+        serial solver.
+
+        The grid is allocated by the solver; the parent writes deposits and
+        restored checkpoints into it between steps, which puts every change
+        straight into the memory of the strip that owns it. A worker that
+        raises or dies breaks the barriers, and `step` raises a RuntimeError
+        naming its strip.
+    """
+    # Strips always cover the whole grid
+    supports_blocks = False
+
+    def __init__(self, dx, dt, backend="auto", processes=2, threads=1, timeout=STEP_TIMEOUT):
+        self.dx = dx
+        self.dt = dt
+        self.backend = backend
+        self.processes = processes
+        self.threads = threads
+        self.timeout = timeout
+        self.workers = []
+
+    def allocate(self, shape, dtype=float):
+        """Zeroed grid in shared memory, with one worker process per row strip"""
+        if multiprocessing.current_process().daemon:
+            raise RuntimeError("pde_processes > 1 cannot run inside a daemonic process (e.g. parallel sweep jobs)")
+        if self.workers:
+            raise RuntimeError("StripEuler grid is already allocated")
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(self.shape)) * self.dtype.itemsize))
+        field = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        field[...] = 0
+
+        self.strips = strip_bounds(self.shape[-2], self.processes)
+        self.barrier = multiprocessing.Barrier(len(self.strips) + 1)
+        self.command = multiprocessing.Value("i", STEP, lock=False)
+        self.workers = [
+            multiprocessing.Process(target=strip_worker, daemon=True,
+                                    args=(self.shm.name, self.shape, self.dtype.str, start, stop, self.dx, self.dt,
+                                          self.backend, self.threads, self.barrier, self.command))
+            for start, stop in self.strips
+        ]
+        for worker in self.workers:
+            worker.start()
+        threading.Thread(target=watch_workers, args=(self.workers, self.barrier), daemon=True).start()
+        self.__finalizer = weakref.finalize(self, release, self.workers, self.barrier, self.command, self.shm)
+        return field
+
+    def step(self, field, blocks=None):
+        """Advance the shared grid by one time step: start, computed, applied"""
+        if field.shape != self.shape:
+            raise ValueError(f"StripEuler steps its own shared grid of shape {self.shape}, got {field.shape}")
+        self.command.value = STEP
+        for _ in range(3):
+            if not all(worker.is_alive() for worker in self.workers):
+                self.barrier.abort()
+                self.__fail()
+            try:
+                self.barrier.wait(timeout=self.timeout)
+            except threading.BrokenBarrierError:
+                self.__fail()
+
+    def __fail(self):
+        """Raise an error naming the strips whose workers failed; the barrier is already broken"""
+        for worker in self.workers:
+            worker.join(timeout=1)
+        failed = [f"rows {start}-{stop} (exit code {worker.exitcode})"
+                  for worker, (start, stop) in zip(self.workers, self.strips) if worker.exitcode not in (None, 0)]
+        if failed:
+            raise RuntimeError(f"StripEuler worker failed on strip {', '.join(failed)}")
+        raise RuntimeError(f"StripEuler workers did not finish a step within {self.timeout} s")
+
+    def close(self):
+        """Stop the workers and free the shared grid; the grid must not be used afterwards"""
+        if self.workers:
+            self.__finalizer()
@@ -1,18 +1,51 @@
 import numpy as np
 
+import modules.Solvers as Solvers
+import modules.Tiles as Tiles
+import modules.Profiler as Profiler
+
+# Most source-window cells evaluated at once by a deposit; larger batches are split into chunks
+DEPOSIT_CHUNK_CELLS = 1 << 21
+# Radius of the Gaussian patch a worm drops
+SOURCE_RADIUS = 0.03
+
 class Environment:
     """
         Pieces of the environment
         ---------------------------
         1. Bacteria Concentration Map (Grid)
-          - Diffusion equation
+          - Reaction-diffusion equation, solved by a selectable PDE solver
         2. Time-course
+          - Worm steps every worm_dt, the PDE sub-cycles pde_substeps
+            steps of dt in between
     """
     def __init__(self, params):
+        self.pde_solver = "euler"
+        self.pde_backend = "auto"
+        self.active_tile_size = 32
+        self.pde_processes = 1
+        self.pde_threads = 1
+        self.precision = "float64"
+        self.worm_dt = 0
+        self.num_replicates = 1
+        self.profiler = Profiler.Profiler()
         self.__set_params(params)
+        self.dtype = np.dtype(self.precision)
         self.__init_environment_grid()
         self.__init_timecourse()
 
+        # Cached deposition window offsets, keyed by patch radius
+        self.__stamp_offsets = {}
+
+        # Bumped on every change of the bacteria map; keys the cached gradient
+        self.map_version = 0
+        self.__gradient = None
+        self.__gradient_version = -1
+
+        # PDE solver for the bacteria concentration
+        self.solver = Solvers.make_solver(self.pde_solver, self.dx, self.dt, self.pde_backend,
+                                          self.pde_processes, self.pde_threads)
+
         # Bacteria concentration grid
         self.bacteria_map = []
         self.__init_bacteria_map()
@@ -31,75 +64,203 @@ class Environment:
         print("Creating environment grid...")
         X1 = np.arange(self.x_min, self.x_max + self.dx, self.dx)
         X2 = np.arange(self.x_min, self.x_max + self.dx, self.dx)
-        self.x_grid, self.y_grid = np.meshgrid(X1, X2)
+        # 1-D axes only: grid cell (i, j) sits at (x_axis[j], y_axis[i])
+        self.x_axis = X1
+        self.y_axis = X2
+        self.grid_shape = (X2.shape[0], X1.shape[0])
     
     def __init_timecourse(self):
-        """Create 1D temporal/time grid using t_min, t_max, dt"""
+        """Create 1D temporal/time grid of worm steps using t_min, t_max, worm_dt"""
         print("Creating timecourse...")
-        self.t_grid = np.arange(self.t_min, self.t_max, self.dt)
+        # Worm dt must be a whole number of PDE steps; 0 means one PDE step per worm step
+        substeps = self.worm_dt / self.dt if self.worm_dt else 1
+        if substeps < 1 or not np.isclose(substeps, round(substeps)):
+            raise ValueError(f"worm_dt ({self.worm_dt}) must be a positive multiple of dt ({self.dt})")
+        self.pde_substeps = int(round(substeps))
+        self.worm_dt = self.pde_substeps * self.dt
+        self.t_grid = np.arange(self.t_min, self.t_max, self.worm_dt)
 
     def __init_bacteria_map(self):
-        """Initialize bacteria concentration map to zeros"""
-        self.bacteria_map = np.zeros_like(self.x_grid, dtype=float)
+        """Initialize bacteria concentration map to zeros in the run's precision, stacked (R, H, W) in ensemble mode"""
+        replicate_shape = () if self.num_replicates == 1 else (self.num_replicates,)
+        self.bacteria_map = self.solver.allocate(replicate_shape + self.grid_shape, self.dtype)
+        self.__init_active_tiles()
         self.init_bacteria_patch(x_center=0.0, y_center=0.0, radius=0.1, amplitude=1)
 
-    def init_bacteria_patch(self, x_center, y_center, radius, amplitude):
+    def __get_stamp_offsets(self, radius):
+        """Index offsets of the square window covering 3*radius around a grid cell"""
+        if radius not in self.__stamp_offsets:
+            half_width = int(np.ceil(3 * radius / self.dx)) + 1
+            self.__stamp_offsets[radius] = np.arange(-half_width, half_width + 1)
+        return self.__stamp_offsets[radius]
+
+    def __window_axis(self, axis, center, offsets):
+        """Grid indices, validity mask and distances to the center of each source window along one axis"""
+        nearest = np.rint((center - self.x_min) / self.dx).astype(int)
+        idx = nearest[:, None] + offsets[None, :]
+        valid = (idx >= 0) & (idx < axis.shape[0])
+        idx = np.clip(idx, 0, axis.shape[0] - 1)
+        delta = axis[idx] - center[:, None]
+        return idx, valid, delta
+
+    def __init_active_tiles(self):
+        """Track active tiles when the solver can update parts of the grid"""
+        self.active_tiles = None
+        if self.active_tile_size > 0 and self.solver.supports_blocks:
+            self.active_tiles = Tiles.ActiveTiles(self.grid_shape, self.active_tile_size)
+            self.active_tiles.reset(self.bacteria_map)
+
+    def init_bacteria_patch(self, x_center, y_center, radius, amplitude, replicate=None):
         """
-        Initialize a Gaussian patch of bacteria at (x_center, y_center)
-        Only sets bacteria within a certain radius, keeps rest at zero
+        Initialize Gaussian patches of bacteria at (x_center, y_center)
+        Only sets bacteria within a certain radius, keeps rest at zero.
+        Centers and amplitudes may be scalars or arrays; all patches are
+        evaluated on small windows around their centers and summed into the
+        map in chunks of at most DEPOSIT_CHUNK_CELLS window cells, so memory
+        stays bounded however many sources drop at once. In ensemble mode
+        `replicate` gives the replicate of every source; None deposits into
+        all replicates.
         """
-        dx = self.x_grid - x_center
-        dy = self.y_grid - y_center
-        dist_sq = dx**2 + dy**2
-        
-        # Create Gaussian
-        gaussian = amplitude * np.exp(-dist_sq / (2 * radius**2))
-        
-        # Only apply where distance < 3*radius (99.7% of distribution) and everything outside the mask stays at 0
-        mask = np.sqrt(dist_sq) < (3 * radius)
-        self.bacteria_map[mask] += gaussian[mask]
-
-        # Clip to prevent exceeding carrying capacity to value of 1
-        self.bacteria_map = np.clip(self.bacteria_map, 0, 1)
+        x_center, y_center, amplitude = np.broadcast_arrays(
+            np.atleast_1d(np.asarray(x_center, dtype=float)),
+            np.atleast_1d(np.asarray(y_center, dtype=float)),
+            np.atleast_1d(np.asarray(amplitude, dtype=float)))
+        if x_center.size == 0:
+            return
+        if replicate is not None and self.bacteria_map.ndim == 3:
+            replicate = np.broadcast_to(replicate, x_center.shape)
+        else:
+            replicate = None
+
+        offsets = self.__get_stamp_offsets(radius)
+        chunk = max(1, DEPOSIT_CHUNK_CELLS // offsets.shape[0]**2)
+        for start in range(0, x_center.shape[0], chunk):
+            sources = slice(start, start + chunk)
+            self.__deposit(x_center[sources], y_center[sources], amplitude[sources],
+                           None if replicate is None else replicate[sources], radius, offsets)
+        self.map_version += 1
+
+    def __deposit(self, x_center, y_center, amplitude, replicate, radius, offsets):
+        """Add one chunk of Gaussian patches, summed per cell with bincount, and clip the touched cells"""
+        # Per-source windows: rows follow y, columns follow x
+        cols, valid_cols, dx = self.__window_axis(self.x_axis, x_center, offsets)
+        rows, valid_rows, dy = self.__window_axis(self.y_axis, y_center, offsets)
+        dist_sq = dx[:, None, :]**2 + dy[:, :, None]**2
+
+        # Only apply where distance < 3*radius (99.7% of distribution) and inside the grid
+        mask = (np.sqrt(dist_sq) < (3 * radius)) & valid_rows[:, :, None] & valid_cols[:, None, :]
+        gaussian = np.broadcast_to(amplitude[:, None, None], mask.shape)[mask] * np.exp(-dist_sq[mask] / (2 * radius**2))
+
+        # Flat cell of every window cell; with per-source replicates the cells of the whole stack
+        height, width = self.grid_shape
+        cell = rows[:, :, None] * width + cols[:, None, :]
+        if replicate is not None:
+            cell = cell + replicate[:, None, None] * (height * width)
+        cell = cell[mask]
+
+        # Sum per touched cell: densely when the chunk covers more cells than the grid has, else over unique cells
+        num_cells = self.bacteria_map.size if replicate is not None else height * width
+        if cell.shape[0] >= num_cells:
+            touched = np.zeros(num_cells, dtype=bool)
+            touched[cell] = True
+            cells = np.flatnonzero(touched)
+            sums = np.bincount(cell, weights=gaussian, minlength=num_cells)[cells]
+        else:
+            cells, inverse = np.unique(cell, return_inverse=True)
+            sums = np.bincount(inverse, weights=gaussian)
+        sums = sums.astype(self.bacteria_map.dtype, copy=False)
+
+        # Clip touched cells to prevent exceeding carrying capacity to value of 1
+        grid = self.bacteria_map.reshape(1, -1) if replicate is not None else self.bacteria_map.reshape(-1, height * width)
+        grid[:, cells] = np.clip(grid[:, cells] + sums, 0, 1)
+
+        # Touched tiles (and through them their neighbours) must be updated again
+        if self.active_tiles is not None:
+            plane_cells = cells % (height * width)
+            self.active_tiles.mark(plane_cells // width, plane_cells % width)
 
     def update_bacteria_map(self):
         """
-        Solve ∂b/∂t = ∇²b + b(1-b) using finite differences
+        Solve ∂b/∂t = ∇²b + b(1-b) over one worm step (pde_substeps solver steps)
+        With active tiles, only tiles that can change are updated
         """
-        # Compute Laplacian (diffusion term)
-        laplacian = self.__compute_laplacian(self.bacteria_map)
-        # Compute logistic growth term with r = 1
-        growth = self.bacteria_map * (1 - self.bacteria_map)
-        # Forward Euler time step: b_new = b_old + dt * (∇²b + b(1-b))
-        self.bacteria_map += self.dt * (laplacian + growth)
-        # Clamp to [0, 1] to avoid numerical instability
-        self.bacteria_map = np.clip(self.bacteria_map, 0, 1)
-
-    def __compute_laplacian(self, field):
+        self.map_version += 1
+        for _ in range(self.pde_substeps):
+            if self.active_tiles is None:
+                self.solver.step(self.bacteria_map)
+                continue
+            self.solver.step(self.bacteria_map, self.active_tiles.blocks())
+            self.active_tiles.update(self.bacteria_map)
+
+    def add_bacteria_source(self, x, y, amount, replicate=None):
+        """Deposits bacteria as small patches at (x,y), scalars or arrays of sources"""
+        with self.profiler.phase("environment.add_bacteria_source"):
+            self.init_bacteria_patch(x_center=x, y_center=y, radius=SOURCE_RADIUS, amplitude=amount, replicate=replicate)
+
+    def checkpoint_state(self):
+        """Arrays needed to resume the environment exactly"""
+        return {"bacteria_map": self.bacteria_map}
+
+    def restore_state(self, state):
+        """Restore the bacteria map saved by checkpoint_state"""
+        self.bacteria_map[...] = state["bacteria_map"]
+        self.map_version += 1
+        if self.active_tiles is not None:
+            self.active_tiles.reset(self.bacteria_map)
+
+    def __bilinear_corners(self, x, y, replicate):
+        """Indices of the four surrounding grid cells and interpolation weights for arrays of points"""
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        height, width = self.grid_shape
+        # Points outside the grid take the value at the nearest edge
+        col = np.clip((x - self.x_min) / self.dx, 0, width - 1)
+        row = np.clip((y - self.x_min) / self.dx, 0, height - 1)
+        col0 = np.minimum(col.astype(int), width - 2)
+        row0 = np.minimum(row.astype(int), height - 2)
+        weight_x = col - col0
+        weight_y = row - row0
+
+        # In ensemble mode points are (R, ...) arrays unless their replicates are given
+        prefix = ()
+        if self.bacteria_map.ndim == 3:
+            if replicate is None:
+                replicate = np.arange(self.num_replicates).reshape((-1,) + (1,) * (x.ndim - 1))
+            prefix = (np.broadcast_to(replicate, x.shape),)
+
+        corners = [prefix + (row0 + d_row, col0 + d_col) for d_row in (0, 1) for d_col in (0, 1)]
+        weights = [(1 - weight_y) * (1 - weight_x), (1 - weight_y) * weight_x,
+                   weight_y * (1 - weight_x), weight_y * weight_x]
+        return corners, weights
+
+    def __interpolate(self, field, x, y, replicate):
+        """Bilinear interpolation of a grid field at arrays of points"""
+        corners, weights = self.__bilinear_corners(x, y, replicate)
+        return sum(weight * field[corner] for corner, weight in zip(corners, weights))
+
+    def bacteria_gradient(self):
+        """Spatial gradient (d/dx, d/dy) of the bacteria map, recomputed only after the map changed"""
+        if self.__gradient_version != self.map_version:
+            d_dy, d_dx = np.gradient(self.bacteria_map, self.dx, axis=(-2, -1))
+            self.__gradient = (d_dx, d_dy)
+            self.__gradient_version = self.map_version
+        return self.__gradient
+
+    def sample_bacteria(self, x, y, replicate=None):
         """
-        Compute ∇²b using 9-point stencil (includes diagonals)
+        Bilinearly interpolated bacteria concentration at arrays of points
+        In ensemble mode x and y are (R, N) like the worm state, or
+        `replicate` gives the replicate of every point.
         """
-        laplacian = np.zeros_like(field)
-        dx2 = self.dx ** 2
-        
-        # 9-point stencil: includes diagonal neighbors
-        laplacian[1:-1, 1:-1] = (
-            # Cardinal directions (weight = 1)
-            field[2:, 1:-1] + field[:-2, 1:-1] +
-            field[1:-1, 2:] + field[1:-1, :-2] +
-            # Diagonal directions (weight = 0.5)
-            0.5 * (field[2:, 2:] + field[:-2, :-2] + 
-                   field[2:, :-2] + field[:-2, 2:]) -
-            # Center (weight = 6)
-            6 * field[1:-1, 1:-1]
-        ) / dx2
-        return laplacian
-
-    def add_bacteria_source(self, x, y, amount):
-        """Deposits bacteria as a small patch at (x,y)"""
-        self.init_bacteria_patch(x_center=x, y_center=y, radius=0.03, amplitude=amount)
+        return self.__interpolate(self.bacteria_map, x, y, replicate)
+
+    def sample_gradient(self, x, y, replicate=None):
+        """Bilinearly interpolated concentration gradient (d/dx, d/dy) at arrays of points"""
+        d_dx, d_dy = self.bacteria_gradient()
+        corners, weights = self.__bilinear_corners(x, y, replicate)
+        return (sum(weight * d_dx[corner] for corner, weight in zip(corners, weights)),
+                sum(weight * d_dy[corner] for corner, weight in zip(corners, weights)))
 
     def convert_xy_to_index(self, xy):
         """Convert real coordinates (x or y) to grid indices"""
-        index = ((xy - self.x_min) / (self.x_max - self.x_min)) * self.x_grid.shape[0]
+        index = ((xy - self.x_min) / (self.x_max - self.x_min)) * self.x_axis.shape[0]
         return index
\ No newline at end of file
@@ -0,0 +1,245 @@
+import os
+import sys
+import copy
+import shutil
+import resource
+
+import numpy as np
+
+import modules.Setup as Setup
+import modules.Stencil as Stencil
+import modules.Profiler as Profiler
+import modules.Environment as Environment
+import modules.Keeper as Keeper
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Worm steps timed by the calibration run, after one warm-up step
+CALIBRATION_STEPS = 5
+# Float64 grid copies alive at once inside the spectral solvers (mirrored grid, spectra, inverse):
+# per replicate, plus the transfer function and FFT plans shared by all replicates
+SPECTRAL_WORK_COPIES = 17
+SPECTRAL_SHARED_COPIES = 3
+SPECTRAL_FIXED_BYTES = 16 * 2**20
+# Resident memory of LLVM and the compiled stencil kernel once the numba backend is loaded
+JIT_BYTES = 48 * 2**20
+# Private memory of a forked strip worker, and of the stencil kernel it loads from the numba cache
+WORKER_BYTES = 8 * 2**20
+WORKER_JIT_BYTES = 28 * 2**20
+# Deposit temporaries per source-window cell: distances, mask, Gaussian and flat cells, and the
+# sort of np.unique when a chunk is summed over its unique cells rather than densely over the grid
+DEPOSIT_BYTES_PER_CELL = 32
+DEPOSIT_SORT_BYTES_PER_CELL = 64
+# Touched-cell mask and dense sums per grid cell of a dense deposit
+DEPOSIT_BYTES_PER_GRID_CELL = 9
+# Integer worm record fields written by Keeper (t, worm_i, state, timestep) and float ones (x, y, angle)
+RECORD_INT_FIELDS = 4
+RECORD_FLOAT_FIELDS = 3
+
+def format_bytes(num_bytes):
+    # Human readable size
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(num_bytes) < 1024 or unit == "TB":
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+
+def peak_rss_bytes():
+    # Peak resident set size of this process (ru_maxrss is in KB on Linux, bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def current_rss_bytes():
+    # Resident set size of this process now; unlike the peak it excludes memory freed by earlier runs
+    try:
+        with open("/proc/self/statm") as infile:
+            return int(infile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    return peak_rss_bytes()
+
+def free_disk(path):
+    # Free space on the file system that will hold path
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+def snapshot_window(keeper_params, env, size):
+    # Stored rows and columns of a bacteria snapshot, as Keeper selects them
+    stride = keeper_params["snapshot_downsample"]
+    roi = keeper_params["snapshot_roi"]
+    if roi is None:
+        return len(range(0, size, stride)), len(range(0, size, stride))
+    x_lo, x_hi, y_lo, y_hi = roi
+    cols = range(*Keeper.roi_range(x_lo, x_hi, env["x_min"], env["dx"], size), stride)
+    rows = range(*Keeper.roi_range(y_lo, y_hi, env["x_min"], env["dx"], size), stride)
+    return len(rows), len(cols)
+
+def snapshot_itemsize(keeper_params):
+    # Bytes per stored snapshot cell: quantized codes, or floats no wider than the run's precision
+    dtype = np.dtype(keeper_params["snapshot_dtype"])
+    if dtype.kind == "f":
+        return min(dtype.itemsize, np.dtype(keeper_params["precision"]).itemsize)
+    return dtype.itemsize
+
+def estimate(cfg):
+    # Sizes of everything a run allocates and writes, from its resolved parameters
+    # Only parameters are needed, so the experiment directories are not created
+    planned_dirs = cfg.base_dir if cfg.num_replicates == 1 else [cfg.base_dir] * cfg.num_replicates
+    world_params = Setup.world_parameters(cfg, planned_dirs)
+    env = world_params["environment"]
+    keeper_params = world_params["keeper"]
+    keeper_params = keeper_params[0] if isinstance(keeper_params, list) else keeper_params
+
+    # Grid and time course, as Environment builds them
+    axis = np.arange(env["x_min"], env["x_max"] + env["dx"], env["dx"])
+    substeps = int(round(env["worm_dt"] / env["dt"])) if env["worm_dt"] else 1
+    num_steps = np.arange(env["t_min"], env["t_max"], substeps * env["dt"]).shape[0]
+    replicates = env["num_replicates"]
+    itemsize = np.dtype(env["precision"]).itemsize
+    num_cells = axis.shape[0] ** 2
+
+    # The JIT is loaded by the euler stencil when the numba backend is selected or available
+    uses_jit = env["pde_solver"] == "euler" and (
+        env["pde_backend"] == "numba" or (env["pde_backend"] == "auto" and Stencil.numba is not None))
+
+    grid_bytes = replicates * num_cells * itemsize
+    if env["pde_solver"] == "euler":
+        # Stencil work buffers are allocated empty and only touched ones become resident:
+        # the fused numba kernel writes the update buffer, NumPy also the Laplacian and scratch
+        solver_bytes = (1 if uses_jit else 3) * grid_bytes
+    else:
+        solver_bytes = (SPECTRAL_WORK_COPIES * replicates + SPECTRAL_SHARED_COPIES) * num_cells * 8 + SPECTRAL_FIXED_BYTES
+
+    # Strip workers are forked from this process; with them the parent never loads the JIT
+    processes = min(env["pde_processes"], axis.shape[0]) if env["pde_processes"] > 1 else 0
+    worker_bytes = processes * (WORKER_BYTES + (WORKER_JIT_BYTES if uses_jit else 0))
+    jit_bytes = JIT_BYTES if uses_jit and not processes else 0
+
+    # Worm state: position, heading and durations in the run's precision, state, timers and ids
+    num_worms = cfg.num_worms
+    worm_bytes = replicates * num_worms * (5 * itemsize + 1 + 2 * 8) + num_worms * 8
+
+    # Every worm may drop on the same step (they all start due); deposits run in bounded chunks
+    window = 2 * (int(np.ceil(3 * Environment.SOURCE_RADIUS / env["dx"])) + 1) + 1
+    chunk_cells = min(replicates * num_worms * window**2, Environment.DEPOSIT_CHUNK_CELLS)
+    if chunk_cells >= replicates * num_cells:
+        deposit_bytes = chunk_cells * DEPOSIT_BYTES_PER_CELL + replicates * num_cells * DEPOSIT_BYTES_PER_GRID_CELL
+    else:
+        deposit_bytes = chunk_cells * DEPOSIT_SORT_BYTES_PER_CELL
+
+    # Keeper buffers hold flush_every steps per replicate, allocated empty so a shorter run never touches
+    # all of them; files hold every measured step
+    snapshot_cells = int(np.prod(snapshot_window(keeper_params, env, axis.shape[0])))
+    snapshot_bytes = snapshot_cells * snapshot_itemsize(keeper_params) + 8
+    record_bytes = RECORD_INT_FIELDS * 8 + RECORD_FLOAT_FIELDS * itemsize
+    num_snapshots = len(range(0, num_steps, keeper_params["snapshot_interval"]))
+    if keeper_params["sleeping"]:
+        buffer_bytes = snapshot_output = worm_output = 0
+    else:
+        flush_every = keeper_params["flush_every"]
+        buffer_bytes = replicates * (min(flush_every, num_snapshots) * snapshot_bytes
+                                     + min(flush_every, num_steps) * num_worms * record_bytes)
+        snapshot_output = replicates * num_snapshots * snapshot_bytes
+        worm_output = replicates * num_steps * num_worms * record_bytes
+    checkpoint_bytes = grid_bytes + worm_bytes if cfg.checkpoint_every else 0
+
+    memory = {
+        "process": current_rss_bytes(),
+        "jit": jit_bytes,
+        "grid": grid_bytes,
+        "solver": solver_bytes,
+        "workers": worker_bytes,
+        "worms": worm_bytes,
+        "deposits": deposit_bytes,
+        "buffers": buffer_bytes,
+    }
+    return {
+        "grid_shape": (axis.shape[0], axis.shape[0]),
+        "replicates": replicates,
+        "precision": env["precision"],
+        "num_steps": num_steps,
+        "pde_substeps": substeps,
+        "memory": memory,
+        "peak_memory": sum(memory.values()),
+        "snapshot_output": snapshot_output,
+        "worm_output": worm_output,
+        "checkpoint": checkpoint_bytes,
+        "output": snapshot_output + worm_output + checkpoint_bytes,
+        "free_disk": free_disk(cfg.base_dir),
+    }
+
+def calibrate(cfg, simulate, steps=CALIBRATION_STEPS):
+    # Seconds per worm step of the actual run, timed on a few steps after a one-step warm-up
+    def build(base_dir, num_steps):
+        cal_cfg = copy.copy(cfg)
+        cal_cfg.base_dir = base_dir
+        cal_cfg.verbose = False
+        cal_cfg.checkpoint_every = 0
+        worm_dt = cal_cfg.worm_dt if cal_cfg.worm_dt > 0 else cal_cfg.dt
+        cal_cfg.t_max = cal_cfg.t_min + (num_steps - 0.5) * worm_dt
+
+        np.random.seed(cal_cfg.random_seed)
+        model_dir = Setup.directories(cal_cfg)
+        return cal_cfg, Setup.world_objects(cal_cfg, Setup.world_parameters(cal_cfg, model_dir))
+
+    timings, _ = Profiler.time_runs(build, simulate, (1, steps))
+    return timings[-1] / steps
+
+def enforce_budget(cfg, max_memory, policy="refuse"):
+    # Check the estimated peak memory against max_memory. "refuse" raises when over budget;
+    # "decimate" shrinks the measurement buffers, then downsamples stored snapshots (updating
+    # cfg in place) and raises only if even that does not fit.
+    # Returns the estimate of the (possibly decimated) run and the settings changed.
+    result = estimate(cfg)
+    if result["peak_memory"] <= max_memory:
+        return result, []
+    if policy == "refuse":
+        raise ValueError(f"Estimated peak memory {format_bytes(result['peak_memory'])} exceeds "
+                         f"--max_memory {format_bytes(max_memory)}; lower dx, num_worms or flush_every, "
+                         f"or pass --memory_policy decimate")
+
+    original = {"flush_every": cfg.flush_every, "snapshot_downsample": cfg.snapshot_downsample}
+    # Smaller buffers only mean more frequent flushes; the stored data is unchanged
+    while result["peak_memory"] > max_memory and cfg.measurements_on and cfg.flush_every > 1:
+        cfg.flush_every = max(1, cfg.flush_every // 2)
+        result = estimate(cfg)
+
+    # Then store every other snapshot cell along each axis until it fits
+    while (result["peak_memory"] > max_memory and cfg.measurements_on
+           and cfg.snapshot_downsample < result["grid_shape"][0]):
+        cfg.snapshot_downsample *= 2
+        result = estimate(cfg)
+
+    if result["peak_memory"] > max_memory:
+        fixed = result["peak_memory"] - result["memory"]["buffers"]
+        raise ValueError(f"Estimated peak memory {format_bytes(result['peak_memory'])} exceeds "
+                         f"--max_memory {format_bytes(max_memory)} even with decimated measurements; "
+                         f"the simulation state alone needs {format_bytes(fixed)}")
+    changes = [f"{key} {val} -> {getattr(cfg, key)}" for key, val in original.items() if getattr(cfg, key) != val]
+    return result, changes
+
+def report(result, seconds_per_step=None):
+    # Printable summary of an estimate
+    height, width = result["grid_shape"]
+    memory = result["memory"]
+    lines = [
+        f"Grid:        {height} x {width} cells x {result['replicates']} replicate(s), {result['precision']}",
+        f"Steps:       {result['num_steps']} worm steps x {result['pde_substeps']} PDE substeps",
+        f"Peak memory: {format_bytes(result['peak_memory'])} (" +
+        ", ".join(f"{key} {format_bytes(val)}" for key, val in memory.items()) + ")",
+        f"Output:      {format_bytes(result['output'])} (snapshots {format_bytes(result['snapshot_output'])}, "
+        f"worm records {format_bytes(result['worm_output'])}, checkpoint {format_bytes(result['checkpoint'])}), "
+        f"{format_bytes(result['free_disk'])} free",
+    ]
+    if seconds_per_step is not None:
+        lines.append(f"Wall time:   {seconds_per_step * result['num_steps']:.1f} s "
+                     f"({seconds_per_step:.4f} s per step from {CALIBRATION_STEPS} calibration steps)")
+    if result["output"] > result["free_disk"]:
+        lines.append("Warning:     output exceeds the free disk space")
+    return "\n".join(lines)
@@ -1,72 +1,289 @@
 import numpy as np
 import h5py
 
+import modules.Profiler as Profiler
+
+def roi_range(lo, hi, axis_min, dx, size):
+    # Grid indices [start, stop) of the cells whose centres are nearest to [lo, hi], clipped to the axis;
+    # rounding the grid coordinate keeps a bound that sits on a grid line on it despite float error
+    start = int(np.clip(np.rint((lo - axis_min) / dx), 0, size))
+    stop = int(np.clip(np.rint((hi - axis_min) / dx) + 1, 0, size))
+    return start, stop
+
 class Keeper(object):
+    """
+        Streaming measurement store
+        ---------------------------
+        Measurements are collected in preallocated buffers holding at most
+        `flush_every` timesteps and appended to resizable, chunked HDF5
+        datasets whenever a buffer fills up. Files are closed after every
+        flush, so memory stays bounded and the output on disk is readable
+        even if the run is killed.
+
+        Environment snapshots can be decimated in time (every
+        `snapshot_interval` steps), cropped to a region of interest,
+        downsampled by striding, quantized to unsigned integers with a scale
+        factor and compressed with HDF5 filters. The layout is stored in the
+        attributes of the "bacteria" dataset so readers can undo it.
+    """
+    # Worm record fields and their on-disk dtypes (float fields follow the run's precision)
+    worm_fields = {
+        "t"        : np.int64,
+        "worm_i"   : np.int64,
+        "x"        : np.float64,
+        "y"        : np.float64,
+        "state"    : np.int64,
+        "angle"    : np.float64,
+        "timestep" : np.int64,
+    }
+
+    # Quantized storage: unsigned integer codes spanning the [0, 1] bacteria range
+    quantized_dtypes = {
+        "uint8"  : np.uint8,
+        "uint16" : np.uint16,
+    }
+
     def __init__(self, params):
+        self.flush_every = 50
+        self.snapshot_interval = 1
+        self.snapshot_roi = None
+        self.snapshot_downsample = 1
+        self.snapshot_dtype = "float64"
+        self.compression = None
+        self.compression_level = 4
+        self.precision = "float64"
+        self.profiler = Profiler.Profiler()
         self.__set_params(params)
+        self.__init_storage_format()
         self.__init_history()
-        self.environment_history = []   # List of 2D grids
 
     def __set_params(self, params):
         for key, val in params.items():
             self.__dict__[key] = val
 
-    def __init_history(self):
-        """Initialize history dictionaries to store worm data"""
-        self.worm_history = {
-            "t"     : [],
-            "worm_i" : [],
-            "x"     : [],
-            "y"     : [],
-            "state" : [], 
-            "angle" : [],
-            "timestep" : [],
+    def __init_storage_format(self):
+        """Resolve snapshot dtype, quantization scale and HDF5 filter options"""
+        if self.snapshot_dtype in self.quantized_dtypes:
+            self.storage_dtype = np.dtype(self.quantized_dtypes[self.snapshot_dtype])
+            self.scale_factor = 1.0 / np.iinfo(self.storage_dtype).max
+        else:
+            # Storing wider floats than the simulation computes adds no information
+            self.storage_dtype = min(np.dtype(self.snapshot_dtype), np.dtype(self.precision),
+                                     key=lambda dtype: dtype.itemsize)
+            self.scale_factor = 1.0
+        self.record_dtypes = {key: np.dtype(self.precision) if dtype == np.float64 else np.dtype(dtype)
+                              for key, dtype in self.worm_fields.items()}
+
+        self.filter_options = {}
+        if self.compression not in (None, "none"):
+            self.filter_options["compression"] = self.compression
+            self.filter_options["shuffle"] = True
+            if self.compression == "gzip":
+                self.filter_options["compression_opts"] = self.compression_level
+
+    def __init_snapshot_window(self, environment):
+        """Grid slices of the stored region of interest, with downsampling stride"""
+        stride = self.snapshot_downsample
+        if self.snapshot_roi is None:
+            self.snapshot_rows = slice(0, environment.grid_shape[0], stride)
+            self.snapshot_cols = slice(0, environment.grid_shape[1], stride)
+            return
+
+        x_lo, x_hi, y_lo, y_hi = self.snapshot_roi
+        col_start, col_stop = roi_range(x_lo, x_hi, environment.x_min, environment.dx, environment.grid_shape[1])
+        row_start, row_stop = roi_range(y_lo, y_hi, environment.x_min, environment.dx, environment.grid_shape[0])
+        if col_stop <= col_start or row_stop <= row_start:
+            raise ValueError(f"Snapshot region of interest {self.snapshot_roi} does not overlap the grid")
+        self.snapshot_rows = slice(row_start, row_stop, stride)
+        self.snapshot_cols = slice(col_start, col_stop, stride)
+
+    def __snapshot_attrs(self, environment):
+        """Attributes describing how stored snapshots map back onto the full grid"""
+        return {
+            "snapshot_interval" : self.snapshot_interval,
+            "row_start"         : self.snapshot_rows.start,
+            "col_start"         : self.snapshot_cols.start,
+            "stride"            : self.snapshot_downsample,
+            "grid_shape"        : environment.grid_shape,
+            "scale_factor"      : self.scale_factor,
         }
 
-        states = ["run", "tumble"]
-        self.state_encoding = { state : i for i, state in enumerate(states) }
-
-    def __update_worm_history(self, worm_info):
-        for key, val in worm_info.items():
-            self.worm_history[key].append(val)
-
-    def __write_environment_data(self):
-        """Save bacteria grid time series (3D: [time, height, width])"""
-        with h5py.File(self.environment_path, 'w') as outfile:
-            outfile.create_dataset("bacteria", data=self.environment_history)
-            
-    def __write_worm_data(self):
-        """Save worm history to HDF5 file"""
-        with h5py.File(self.worm_path, 'w') as outfile:
+    def __init_history(self):
+        """Initialize buffer state; buffers are allocated on first measurement"""
+        self.environment_history = None    # Buffer of 2D grids [flush_every, height, width]
+        self.environment_t = None          # Timestep of each buffered grid
+        self.worm_history = None           # Buffers of worm records, one array per field
+        self.environment_count = 0         # Snapshots currently buffered
+        self.worm_count = 0                # Worm records currently buffered
+        self.environment_written = 0       # Snapshots already on disk
+        self.worm_written = 0              # Worm records already on disk
+        self.__files_created = set()
+
+    def __open_outfile(self, path):
+        """Open an output file, truncating results of earlier runs on first use"""
+        mode = 'a' if path in self.__files_created else 'w'
+        self.__files_created.add(path)
+        return h5py.File(path, mode)
+
+    def __append(self, outfile, key, data, attrs=None, **filter_options):
+        """Append rows to a resizable chunked dataset, creating it if needed"""
+        if key not in outfile:
+            chunk_rows = 1 if data.ndim > 1 else int(np.clip(data.shape[0], 1024, 65536))
+            outfile.create_dataset(key, shape=(0,) + data.shape[1:], maxshape=(None,) + data.shape[1:],
+                                   dtype=data.dtype, chunks=(chunk_rows,) + data.shape[1:], **filter_options)
+            outfile[key].attrs.update(attrs or {})
+        dataset = outfile[key]
+        start = dataset.shape[0]
+        dataset.resize(start + data.shape[0], axis=0)
+        dataset[start:] = data
+
+    def __flush_environment_data(self):
+        """Append buffered bacteria grids to the time series (3D: [time, height, width])"""
+        if self.environment_count == 0:
+            return
+        with self.profiler.phase("keeper.flush_environment"), self.__open_outfile(self.environment_path) as outfile:
+            self.__append(outfile, "bacteria", self.environment_history[:self.environment_count],
+                          attrs=self.environment_attrs, **self.filter_options)
+            self.__append(outfile, "t", self.environment_t[:self.environment_count])
+        self.environment_written += self.environment_count
+        self.environment_count = 0
+
+    def __flush_worm_data(self):
+        """Append buffered worm records to the worm history"""
+        if self.worm_count == 0:
+            return
+        with self.profiler.phase("keeper.flush_worms"), self.__open_outfile(self.worm_path) as outfile:
             for key, val in self.worm_history.items():
-                outfile.create_dataset(key, data=val)
+                self.__append(outfile, key, val[:self.worm_count])
+        self.worm_written += self.worm_count
+        self.worm_count = 0
+
+    def measure_environment(self, environment, global_i, replicate=None):
+        """Record bacteria grid snapshot at current timestep, every snapshot_interval steps"""
+        if self.sleeping or global_i % self.snapshot_interval:
+            return
+
+        bacteria_map = environment.bacteria_map
+        if replicate is not None:
+            bacteria_map = bacteria_map[replicate]
 
-    def measure_environment(self, environment):
-        """Record bacteria grid snapshot at current timestep"""
+        if self.environment_history is None:
+            self.__init_snapshot_window(environment)
+            self.environment_attrs = self.__snapshot_attrs(environment)
+            window_shape = bacteria_map[self.snapshot_rows, self.snapshot_cols].shape
+            self.environment_history = np.empty((self.flush_every,) + window_shape, dtype=self.storage_dtype)
+            self.environment_t = np.empty(self.flush_every, dtype=np.int64)
+
+        snapshot = bacteria_map[self.snapshot_rows, self.snapshot_cols]
+        if self.scale_factor != 1.0:
+            snapshot = np.rint(snapshot / self.scale_factor)
+        self.environment_history[self.environment_count] = snapshot
+        self.environment_t[self.environment_count] = global_i
+        self.environment_count += 1
+        if self.environment_count == self.flush_every:
+            self.__flush_environment_data()
+
+    def measure_worms(self, worms, global_i, replicate=None):
+        """Record state of every worm in the population at current timestep"""
         if self.sleeping:
             return
-        self.environment_history.append(environment.bacteria_map.copy())
 
-    
-    def measure_worms(self, worm, global_i):
-        """Record worm state at current timestep"""
+        # In ensemble mode only this keeper's replicate is recorded
+        x, y, state, angle = worms.x, worms.y, worms.state, worms.angle
+        if replicate is not None:
+            x, y, state, angle = x[replicate], y[replicate], state[replicate], angle[replicate]
+
+        num_worms = len(worms)
+        if self.worm_history is None or self.worm_count + num_worms > self.worm_history["t"].shape[0]:
+            self.__flush_worm_data()
+            capacity = self.flush_every * num_worms
+            self.worm_history = {key: np.empty(capacity, dtype=dtype) for key, dtype in self.record_dtypes.items()}
+
+        rows = slice(self.worm_count, self.worm_count + num_worms)
+        self.worm_history["t"][rows] = global_i
+        self.worm_history["worm_i"][rows] = worms.num
+        self.worm_history["x"][rows] = x
+        self.worm_history["y"][rows] = y
+        self.worm_history["state"][rows] = state
+        self.worm_history["angle"][rows] = angle
+        self.worm_history["timestep"][rows] = worms.timestep
+        self.worm_count += num_worms
+        if self.worm_count == self.worm_history["t"].shape[0]:
+            self.__flush_worm_data()
+
+    def log_data_to_handy_dandy_notebook(self):
+        """Flush whatever is still buffered to disk"""
         if self.sleeping:
             return
 
-        worm_info = {
-            "t"      : global_i,
-            "worm_i" : worm.num,
-            "x"      : worm.x,
-            "y"      : worm.y,
-            "state"  : self.state_encoding[worm.state],
-            "angle"  : worm.angle,
-            "timestep": worm.timestep,
+        self.__flush_environment_data()
+        self.__flush_worm_data()
+
+    def buffer_nbytes(self):
+        """Bytes held in measurement buffers"""
+        num_bytes = 0
+        if self.environment_history is not None:
+            num_bytes += self.environment_history.nbytes + self.environment_t.nbytes
+        if self.worm_history is not None:
+            num_bytes += sum(val.nbytes for val in self.worm_history.values())
+        return num_bytes
+
+    def checkpoint_state(self):
+        """Flush buffers and return the number of rows on disk"""
+        self.log_data_to_handy_dandy_notebook()
+        return {
+            "environment_written" : np.array(self.environment_written),
+            "worm_written"        : np.array(self.worm_written),
         }
-        self.__update_worm_history(worm_info)
 
-    def log_data_to_handy_dandy_notebook(self):
+    def __truncate(self, path, num_rows):
+        """Drop rows written after a checkpoint and keep appending to the file"""
+        if num_rows == 0:
+            return
+        with h5py.File(path, 'a') as outfile:
+            for dataset in outfile.values():
+                dataset.resize(num_rows, axis=0)
+        self.__files_created.add(path)
+
+    def restore_state(self, state):
+        """Resume writing at the row offsets saved by checkpoint_state"""
         if self.sleeping:
             return
-        
-        self.__write_environment_data()
-        self.__write_worm_data()
\ No newline at end of file
+        self.environment_written = int(state["environment_written"])
+        self.worm_written = int(state["worm_written"])
+        self.__truncate(self.environment_path, self.environment_written)
+        self.__truncate(self.worm_path, self.worm_written)
+
+
+class EnsembleKeeper(object):
+    """
+        Keepers of an ensemble run
+        --------------------------
+        Routes the measurements of every replicate of a stacked ensemble
+        simulation to that replicate's own Keeper and experiment folder.
+    """
+    def __init__(self, keepers):
+        self.keepers = keepers
+
+    def measure_environment(self, environment, global_i):
+        for replicate, keeper in enumerate(self.keepers):
+            keeper.measure_environment(environment, global_i, replicate)
+
+    def measure_worms(self, worms, global_i):
+        for replicate, keeper in enumerate(self.keepers):
+            keeper.measure_worms(worms, global_i, replicate)
+
+    def log_data_to_handy_dandy_notebook(self):
+        for keeper in self.keepers:
+            keeper.log_data_to_handy_dandy_notebook()
+
+    def buffer_nbytes(self):
+        return sum(keeper.buffer_nbytes() for keeper in self.keepers)
+
+    def checkpoint_state(self):
+        states = [keeper.checkpoint_state() for keeper in self.keepers]
+        return {key: np.stack([state[key] for state in states]) for key in states[0]}
+
+    def restore_state(self, state):
+        for replicate, keeper in enumerate(self.keepers):
+            keeper.restore_state({key: val[replicate] for key, val in state.items()})
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import tempfile
+import contextlib
+
+def time_runs(build, simulate, run_args):
+    # Wall time of simulate(cfg, **world_objects) for every entry of run_args, each run built by
+    # build(base_dir, arg) -> (cfg, world_objects) in a scratch directory with its output silenced.
+    # The first run warms up imports, JIT compilation and the allocator and is not counted.
+    # Returns the timings of the counted runs and the world objects of the last one
+    timings = []
+    for arg in run_args:
+        with tempfile.TemporaryDirectory() as base_dir, open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            cfg, world_objects = build(base_dir, arg)
+            start = time.perf_counter()
+            simulate(cfg, **world_objects)
+            timings.append(time.perf_counter() - start)
+    return timings[1:], world_objects
+
+class Phase(object):
+    """Reusable timer context for one named phase"""
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.profiler.add_time(self.name, time.perf_counter() - self.start)
+
+
+class Profiler(object):
+    """
+        Per-phase wall-clock profiling
+        ------------------------------
+        `with profiler.phase(name):` accumulates time and call counts per
+        phase; `sample_bytes` tracks the current and peak size of buffers.
+        A disabled profiler hands out a shared no-op context, so the
+        instrumentation can stay in the hot path. Phases may be nested
+        (e.g. deposits inside the worm step), in which case the inner time
+        is also included in the outer phase.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = {}
+        self.totals = {}
+        self.calls = {}
+        self.bytes_peak = {}
+        self.bytes_last = {}
+        self.null_phase = contextlib.nullcontext()
+        self.start = time.perf_counter()
+
+    def phase(self, name):
+        """Context manager timing one call of a phase"""
+        if not self.enabled:
+            return self.null_phase
+        if name not in self.phases:
+            self.phases[name] = Phase(self, name)
+            self.totals[name] = 0.0
+            self.calls[name] = 0
+        return self.phases[name]
+
+    def add_time(self, name, seconds):
+        self.totals[name] += seconds
+        self.calls[name] += 1
+
+    def sample_bytes(self, name, num_bytes):
+        """Record the current size of a buffer"""
+        if not self.enabled:
+            return
+        self.bytes_last[name] = num_bytes
+        self.bytes_peak[name] = max(num_bytes, self.bytes_peak.get(name, 0))
+
+    def report(self, num_steps):
+        """Timing report as a dict"""
+        wall_time = time.perf_counter() - self.start
+        phases = {
+            name: {
+                "calls"        : self.calls[name],
+                "total_s"      : self.totals[name],
+                "mean_us"      : 1e6 * self.totals[name] / max(self.calls[name], 1),
+                "fraction"     : self.totals[name] / wall_time if wall_time else 0.0,
+            }
+            for name in sorted(self.totals, key=self.totals.get, reverse=True)
+        }
+        buffers = {
+            name: {"peak_bytes": self.bytes_peak[name], "last_bytes": self.bytes_last[name]}
+            for name in sorted(self.bytes_peak)
+        }
+        return {
+            "wall_time_s"   : wall_time,
+            "num_steps"     : num_steps,
+            "steps_per_s"   : num_steps / wall_time if wall_time else 0.0,
+            "phases"        : phases,
+            "buffers"       : buffers,
+        }
+
+    def summary(self, report):
+        """Readable table of a timing report"""
+        lines = [
+            f"Wall time: {report['wall_time_s']:.3f} s for {report['num_steps']} steps "
+            f"({report['steps_per_s']:.1f} steps/s)",
+            "",
+            f"{'phase':<32}{'calls':>10}{'total [s]':>12}{'mean [us]':>12}{'% wall':>9}",
+        ]
+        for name, stats in report["phases"].items():
+            lines.append(f"{name:<32}{stats['calls']:>10}{stats['total_s']:>12.3f}"
+                         f"{stats['mean_us']:>12.1f}{100 * stats['fraction']:>9.1f}")
+        if report["buffers"]:
+            lines += ["", f"{'buffer':<32}{'peak [MB]':>12}{'last [MB]':>12}"]
+            for name, stats in report["buffers"].items():
+                lines.append(f"{name:<32}{stats['peak_bytes'] / 2**20:>12.2f}{stats['last_bytes'] / 2**20:>12.2f}")
+        lines.append("Nested phases are included in the time of the phase that encloses them.")
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, model_dir, num_steps):
+        """Write timing.json and timing.txt into the experiment directory (every replicate's in ensemble mode)"""
+        if not self.enabled:
+            return
+        report = self.report(num_steps)
+        summary = self.summary(report)
+        for report_dir in (model_dir if isinstance(model_dir, list) else [model_dir]):
+            with open(os.path.join(report_dir, "timing.json"), "w") as outfile:
+                json.dump(report, outfile, indent=2)
+            with open(os.path.join(report_dir, "timing.txt"), "w") as outfile:
+                outfile.write(summary)
+        print(summary)
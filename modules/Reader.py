@@ -0,0 +1,170 @@
+import os
+import numpy as np
+import h5py
+
+# Irregular record selections are read as one contiguous span only while the span is at most
+# this many times the number of requested rows; sparser ones read just those rows
+GATHER_SPAN_FACTOR = 2
+
+class ExperimentReader(object):
+    """
+        Lazy access to an experiment folder
+        -----------------------------------
+        `worm_hist.h5` and `environment_hist.h5` are opened on first use and
+        only the requested slices are read. The worm record layout is indexed
+        once from the integer "t" and "worm_i" columns: when every timestep
+        holds one record per worm in worm order (what Keeper writes) the
+        index is implicit, otherwise a dense (frames, worms) table of record
+        offsets is kept, with -1 for missing records.
+
+        Frames are the distinct worm timesteps. Bacteria snapshots may be
+        thinned out, cropped and quantized by Keeper; `frame_snapshots` maps
+        every frame to the latest snapshot taken at or before it, and
+        `bacteria_frames` undoes the quantization.
+    """
+    worm_fields = ("x", "y", "state", "angle")
+
+    def __init__(self, exp_path):
+        self.exp_path = exp_path
+        self.worm_path = os.path.join(exp_path, "worm_hist.h5")
+        self.environment_path = os.path.join(exp_path, "environment_hist.h5")
+        self.__files = {}
+        self.__build_worm_index()
+        self.__read_bacteria_layout()
+
+    def __getstate__(self):
+        # Open files do not pickle; workers reopen them lazily
+        state = self.__dict__.copy()
+        state["_ExperimentReader__files"] = {}
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close open files; they are reopened on the next read"""
+        for infile in self.__files.values():
+            infile.close()
+        self.__files = {}
+
+    def __file(self, path):
+        if path not in self.__files:
+            self.__files[path] = h5py.File(path, 'r')
+        return self.__files[path]
+
+    def __build_worm_index(self):
+        """Map (frame, worm) to record offsets, reading only the integer columns"""
+        infile = self.__file(self.worm_path)
+        t = infile['t'][:]
+        worm_i = infile['worm_i'][:]
+        self.frame_t, frame_of_record = np.unique(t, return_inverse=True)
+        self.worm_ids = np.unique(worm_i)
+        self.num_frames = self.frame_t.shape[0]
+        self.num_worms = self.worm_ids.shape[0]
+        self.num_records = t.shape[0]
+
+        # Implicit index when record = frame * num_worms + column, else a dense table
+        column = np.searchsorted(self.worm_ids, worm_i)
+        offsets = np.arange(self.num_records)
+        self.record_index = None
+        if not np.array_equal(frame_of_record * self.num_worms + column, offsets):
+            self.record_index = np.full((self.num_frames, self.num_worms), -1, dtype=np.int64)
+            self.record_index[frame_of_record, column] = offsets
+
+    def __read_bacteria_layout(self):
+        """Storage layout of the bacteria snapshots and the snapshot shown at every frame"""
+        self.has_bacteria = False
+        if not os.path.exists(self.environment_path):
+            return
+        infile = self.__file(self.environment_path)
+        if 'bacteria' not in infile or infile['bacteria'].shape[0] == 0:
+            return
+
+        dataset = infile['bacteria']
+        attrs = dataset.attrs
+        self.has_bacteria = True
+        self.num_snapshots, height, width = dataset.shape
+        self.scale_factor = attrs.get('scale_factor', 1.0)
+        self.snapshot_t = infile['t'][:] if 't' in infile else np.arange(self.num_snapshots)
+
+        # Snapshot pixels sit every `stride` cells starting at (row_start, col_start)
+        stride = attrs.get('stride', 1)
+        row_start = attrs.get('row_start', 0)
+        col_start = attrs.get('col_start', 0)
+        self.extent = (col_start - 0.5 * stride, col_start + (width - 0.5) * stride,
+                       row_start + (height - 0.5) * stride, row_start - 0.5 * stride)
+        self.grid_shape = tuple(attrs.get('grid_shape', (height, width)))
+
+        self.frame_snapshots = np.clip(np.searchsorted(self.snapshot_t, self.frame_t, side='right') - 1,
+                                       0, self.num_snapshots - 1)
+
+    def __gather(self, dataset, rows):
+        """Read records at the given offsets (-1 = missing, NaN), skipping the gaps of sparse selections"""
+        valid = rows >= 0
+        if not np.any(valid):
+            return np.full(rows.shape, np.nan)
+        unique, inverse = np.unique(np.where(valid, rows, rows[valid].min()), return_inverse=True)
+        span = unique[-1] - unique[0] + 1
+        if span <= GATHER_SPAN_FACTOR * unique.shape[0]:
+            records = dataset[unique[0]:unique[-1] + 1][unique - unique[0]]
+        else:
+            records = dataset[unique.tolist()]
+        values = records[inverse.reshape(rows.shape)]
+        if not np.all(valid):
+            values = np.where(valid, values, np.nan)
+        return values
+
+    def worm_frames(self, start, stop, fields=("x", "y")):
+        """Worm fields for frames [start, stop) as (frames, worms) arrays"""
+        infile = self.__file(self.worm_path)
+        if self.record_index is None:
+            rows = slice(start * self.num_worms, stop * self.num_worms)
+            return {field: infile[field][rows].reshape(-1, self.num_worms) for field in fields}
+        rows = self.record_index[start:stop]
+        return {field: self.__gather(infile[field], rows) for field in fields}
+
+    def worm_frames_at(self, frames, fields=("x", "y")):
+        """Worm fields of the given increasing frames as (frames, worms) arrays, one read per run of consecutive frames"""
+        frames = np.asarray(frames)
+        breaks = np.flatnonzero(np.diff(frames) != 1) + 1
+        runs = [(run[0], run[-1] + 1) for run in np.split(frames, breaks)]
+        data = [self.worm_frames(start, stop, fields) for start, stop in runs]
+        return {field: np.concatenate([run[field] for run in data]) for field in fields}
+
+    def worm(self, worm_num, fields=worm_fields):
+        """Trajectory of one worm, one entry per frame"""
+        infile = self.__file(self.worm_path)
+        column = np.searchsorted(self.worm_ids, worm_num)
+        if column == self.num_worms or self.worm_ids[column] != worm_num:
+            raise KeyError(f"No worm {worm_num} in {self.worm_path}")
+        if self.record_index is None:
+            return {field: infile[field][column::self.num_worms] for field in fields}
+        rows = self.record_index[:, column]
+        return {field: self.__gather(infile[field], rows) for field in fields}
+
+    def bacteria_frames(self, start, stop):
+        """Bacteria snapshots [start, stop), undoing quantization; float snapshots keep their precision"""
+        frames = self.__file(self.environment_path)['bacteria'][start:stop]
+        if self.scale_factor == 1.0:
+            return frames
+        return frames * self.scale_factor
+
+    def bacteria_snapshots(self, snapshots):
+        """Bacteria snapshots at the given non-decreasing indices, reading each stored snapshot once"""
+        unique, inverse = np.unique(snapshots, return_inverse=True)
+        frames = self.__file(self.environment_path)['bacteria'][unique.tolist()][inverse]
+        if self.scale_factor == 1.0:
+            return frames
+        return frames * self.scale_factor
+
+    def bacteria_range(self, chunk_size=64):
+        """Minimum and maximum concentration over all snapshots, read chunk by chunk"""
+        min_b, max_b = np.inf, -np.inf
+        for start in range(0, self.num_snapshots, chunk_size):
+            chunk = self.bacteria_frames(start, start + chunk_size)
+            min_b = min(min_b, np.min(chunk))
+            max_b = max(max_b, np.max(chunk))
+        return min_b, max_b
@@ -7,8 +7,19 @@ from datetime import datetime
 import modules.Environment as Environment
 import modules.Worms as Worms
 import modules.Keeper as Keeper
-
-def config_options():
+import modules.Profiler as Profiler
+import modules.Streams as Streams
+import modules.Cache as Cache
+
+def memory_size(text):
+    # Parse a size such as "512M", "16G" or a plain number of bytes
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+def config_options(argv=None):
     # Parse command-line arguments and config file
     class LoadFromFile(argparse.Action):
         def __call__(self, parser, namespace, values, option_string=None):
@@ -22,7 +33,28 @@ def config_options():
     # Simulation parameters
     parser.add_argument("--verbose", type=bool, default=True)
     parser.add_argument("--random_seed", type=int, default=42)
+    parser.add_argument("--worm_rng", type=str, default="legacy", choices=["legacy", "streams"],
+                        help="global RNG or per-block Generator streams for the worm model")
+    parser.add_argument("--num_replicates", type=int, default=1, help="replicates with seeds random_seed + r, run as one ensemble")
     parser.add_argument("--measurements_on", type=bool, default=True)
+    parser.add_argument("--flush_every", type=int, default=50)
+    parser.add_argument("--checkpoint_every", type=int, default=0, help="worm steps between checkpoints, 0 disables")
+    parser.add_argument("--resume", action="store_true", help="continue from the last checkpoint if one exists")
+    parser.add_argument("--profile", action="store_true", help="time each phase of the step loop and write timing.json")
+    parser.add_argument("--force", action="store_true", help="recompute even if complete results of this config exist")
+    parser.add_argument("--dry_run", action="store_true", help="report memory, output size and runtime estimates, then exit")
+    parser.add_argument("--max_memory", type=memory_size, default=None, help="peak memory budget, e.g. 16G")
+    parser.add_argument("--memory_policy", type=str, default="refuse", choices=["refuse", "decimate"],
+                        help="refuse to start or decimate measurements when over --max_memory")
+    # Environment snapshot storage
+    parser.add_argument("--snapshot_interval", type=int, default=1)
+    parser.add_argument("--snapshot_roi", type=float, nargs=4, default=None,
+                        metavar=("X_LO", "X_HI", "Y_LO", "Y_HI"))
+    parser.add_argument("--snapshot_downsample", type=int, default=1)
+    parser.add_argument("--snapshot_dtype", type=str, default="float64",
+                        choices=["float64", "float32", "uint16", "uint8"])
+    parser.add_argument("--compression", type=str, default="none", choices=["none", "gzip", "lzf"])
+    parser.add_argument("--compression_level", type=int, default=4)
 
     # Environment parameters
     parser.add_argument("--x_min", type=float, default=-1.5)
@@ -31,9 +63,20 @@ def config_options():
     parser.add_argument("--t_min", type=float, default=0)
     parser.add_argument("--t_max", type=float, default=0.125)
     parser.add_argument("--dt", type=float, default=0.005)
+    parser.add_argument("--worm_dt", type=float, default=0, help="worm step; multiple of dt, 0 uses dt")
+    parser.add_argument("--pde_solver", type=str, default="euler", choices=["euler", "imex", "spectral"])
+    parser.add_argument("--pde_backend", type=str, default="auto", choices=["auto", "numpy", "numba"])
+    parser.add_argument("--active_tile_size", type=int, default=32)
+    parser.add_argument("--pde_processes", type=int, default=1)
+    parser.add_argument("--pde_threads", type=int, default=1)
+    parser.add_argument("--precision", type=str, default="float64", choices=["float64", "float32"],
+                        help="floating point precision of the bacteria grid, worm state and stored records")
 
     # Worm parameters
     parser.add_argument("--num_worms", type=int, default=1)
+    parser.add_argument("--worm_init", type=str, default="lattice", choices=["lattice", "uniform", "clustered", "patch"])
+    parser.add_argument("--worm_min_dist", type=float, default=0.0, help="minimum initial worm spacing (not lattice)")
+    parser.add_argument("--worm_clusters", type=int, default=4)
     parser.add_argument("--worm_step_size", type=float, default=0.1)
     parser.add_argument("--worm_turn_noise", type=float, default=0.2)
     parser.add_argument("--worm_mean_run_duration", type=float, default=3)
@@ -47,13 +90,17 @@ def config_options():
     parser.add_argument("--file", type=open, action=LoadFromFile)
     parser.add_argument("--base_dir", type=str, default="experiments")
 
-    # Read arguments from parser
-    args = parser.parse_args()
+    # Read arguments from parser (command line unless argv is given)
+    args = parser.parse_args(argv)
 
     return args
 
 
-def directory(config):
+def replicate_seeds(config):
+    # Seeds of the replicates simulated together in ensemble mode
+    return [config.random_seed + replicate for replicate in range(config.num_replicates)]
+
+def directory(config, seed=None):
     # Create experiment directory and copy config file
     # timestamp = datetime.now().strftime("%m-%d-%y_%H-%M-%S")
 
@@ -62,11 +109,11 @@ def directory(config):
     else:
         cfg_name = config.config_file.split(os.path.sep)[-1].replace('.cfg', '')
 
-    # Create folder name with parameters
+    # Create folder name with parameters; the config hash keeps runs that differ in any other option apart
     N = config.num_worms
-    seed = config.random_seed
+    seed = config.random_seed if seed is None else seed
     # params_name = f"N{N}_seed{seed}_{timestamp}"
-    params_name = f"N{N}_seed{seed}"
+    params_name = f"N{N}_seed{seed}_{Cache.config_hash(config, seed)}"
     model_dir = os.path.join(config.base_dir, params_name)
 
     os.makedirs(model_dir, exist_ok=True)
@@ -77,15 +124,37 @@ def directory(config):
 
     return model_dir
 
+def directories(config):
+    # One experiment directory per replicate; a single directory unless in ensemble mode
+    if config.num_replicates == 1:
+        return directory(config)
+    return [directory(config, seed) for seed in replicate_seeds(config)]
 
-def world_parameters(cfg, model_dir):
-    # Organize parameters into dictionaries
-    keeper_params = {
+
+def keeper_parameters(cfg, model_dir):
+    # Measurement parameters for the run stored in model_dir
+    return {
         "worm_path": os.path.join(model_dir, "worm_hist.h5"),
         "environment_path": os.path.join(model_dir, "environment_hist.h5"),
         "sleeping": not cfg.measurements_on,
+        "flush_every": cfg.flush_every,
+        "snapshot_interval": cfg.snapshot_interval,
+        "snapshot_roi": cfg.snapshot_roi,
+        "snapshot_downsample": cfg.snapshot_downsample,
+        "snapshot_dtype": cfg.snapshot_dtype,
+        "compression": cfg.compression,
+        "compression_level": cfg.compression_level,
+        "precision": cfg.precision,
     }
 
+def world_parameters(cfg, model_dir):
+    # Organize parameters into dictionaries
+    # In ensemble mode model_dir is a list of replicate directories and each gets its own keeper
+    if isinstance(model_dir, list):
+        keeper_params = [keeper_parameters(cfg, replicate_dir) for replicate_dir in model_dir]
+    else:
+        keeper_params = keeper_parameters(cfg, model_dir)
+
     environment_params = {
         "x_min": cfg.x_min,
         "x_max": cfg.x_max,
@@ -93,6 +162,14 @@ def world_parameters(cfg, model_dir):
         "t_min": cfg.t_min,
         "t_max": cfg.t_max,
         "dt": cfg.dt,
+        "worm_dt": cfg.worm_dt,
+        "pde_solver": cfg.pde_solver,
+        "pde_backend": cfg.pde_backend,
+        "active_tile_size": cfg.active_tile_size,
+        "pde_processes": cfg.pde_processes,
+        "pde_threads": cfg.pde_threads,
+        "precision": cfg.precision,
+        "num_replicates": cfg.num_replicates,
     }
 
     worm_params = {
@@ -103,6 +180,7 @@ def world_parameters(cfg, model_dir):
         "bacteria_enabled": cfg.bacteria_enabled,
         "bacteria_drop_interval": cfg.bacteria_drop_interval,
         "bacteria_amount": cfg.bacteria_amount,
+        "precision": cfg.precision,
     }
 
     world_params = {
@@ -118,9 +196,17 @@ def convert_index_to_xy(idx, idx_min=0, idx_max=300, xy_min=-1.5, xy_max=1.5):
     xy = np.interp(idx, [idx_min, idx_max], [xy_min, xy_max])
     return xy
 
-def generate_points_with_min_distance(num_worms, shape, min_dist):
+# Spread of the worm clusters around their centres in "clustered" initialization
+CLUSTER_SPREAD = 0.1
+# Radius of the initial bacteria patch at the origin, used by "patch" initialization
+PATCH_RADIUS = 0.1
+# Largest acceleration grid of the Poisson-disk initializer
+MAX_PLACEMENT_CELLS = 1 << 25
+
+def generate_points_with_min_distance(num_worms, shape, min_dist, rng=np.random, min_points=None):
     # Generate initial positions for multiple worms
     # Ensures minimum distance between starting positions
+    # At least min_points (default num_worms) coordinates are returned
 
     # Handle edge case: single worm
     if num_worms <= 1:
@@ -134,6 +220,13 @@ def generate_points_with_min_distance(num_worms, shape, min_dist):
     num_y = int(np.sqrt(num_worms / width_ratio)) + 1
     num_x = int(num_worms / num_y) + 1
 
+    # Dropping the border lines can leave too few points for small counts (older versions crashed);
+    # grow the lattice until it fits. Lattices that already fit are unchanged.
+    min_points = num_worms if min_points is None else min_points
+    while (num_x - 2) * (num_y - 2) < min_points:
+        num_x += 1
+        num_y += 1
+
     # Create regularly spaced points
     x = np.linspace(0, shape[1], int(num_x))[1:-1]
     y = np.linspace(0, shape[0], int(num_y))[1:-1]
@@ -145,45 +238,144 @@ def generate_points_with_min_distance(num_worms, shape, min_dist):
     else:
         init_dist = np.min(shape)
 
-    # Perturb points with random noise
-    max_movement = (init_dist - min_dist) / 2
-    noise = np.random.uniform(low=-max_movement,
-                              high=max_movement,
-                              size=(len(coords), 2))
+    # Perturb points with random noise; none if the lattice is already denser than min_dist
+    max_movement = max(init_dist - min_dist, 0) / 2
+    noise = rng.uniform(low=-max_movement,
+                        high=max_movement,
+                        size=(len(coords), 2))
     coords += noise
     return coords
 
-def create_worms(coords, dim, cfg, worm_params):
-    # Create worm objects with initial positions from grid coordinates
-    np.random.shuffle(coords)
-    worms = []
-    
-    for worm_i in range(cfg.num_worms):
-        # Copy params for this worm
-        worm_params_copy = worm_params
-        worm_params_copy["num"] = worm_i
-        
-        # Create worm object
-        worm = Worms.Worm(worm_params_copy)
-
-        # Convert grid indices to real coordinates
-        if cfg.num_worms > 1:
-            # Only use grid placement if multiple worms
-            worm_x_idx = coords[worm_i][0]
-            worm_y_idx = coords[worm_i][1]
-            worm_x = convert_index_to_xy(worm_x_idx, idx_min=0, idx_max=dim, 
-                                        xy_min=cfg.x_min, xy_max=cfg.x_max)
-            worm_y = convert_index_to_xy(worm_y_idx, idx_min=0, idx_max=dim, 
-                                        xy_min=cfg.x_min, xy_max=cfg.x_max)
-            worm.x = worm_x
-            worm.y = worm_y
+def place_worms(coords, dim, cfg, rng=np.random):
+    # Initial worm positions in real coordinates from shuffled grid coordinates
+    rng.shuffle(coords)
+
+    # Convert grid indices to real coordinates
+    if cfg.num_worms > 1:
+        # Only use grid placement if multiple worms
+        worm_coords = coords[:cfg.num_worms]
+        worm_x = convert_index_to_xy(worm_coords[:, 0], idx_min=0, idx_max=dim,
+                                     xy_min=cfg.x_min, xy_max=cfg.x_max)
+        worm_y = convert_index_to_xy(worm_coords[:, 1], idx_min=0, idx_max=dim,
+                                     xy_min=cfg.x_min, xy_max=cfg.x_max)
+        return worm_x, worm_y
+
+    # Single worm: starts at origin
+    return np.zeros(1), np.zeros(1)
+
+def position_proposal(cfg, rng):
+    # Candidate sampler of the initialization mode: returns (x, y) arrays of points inside the arena
+    if cfg.worm_init == "clustered":
+        centers = rng.uniform(cfg.x_min, cfg.x_max, size=(cfg.worm_clusters, 2))
+
+    def propose(size):
+        if cfg.worm_init == "uniform":
+            return rng.uniform(cfg.x_min, cfg.x_max, size=size), rng.uniform(cfg.x_min, cfg.x_max, size=size)
+        if cfg.worm_init == "clustered":
+            center = centers[rng.randint(cfg.worm_clusters, size=size)]
+            x, y = (center + rng.normal(0, CLUSTER_SPREAD, size=(size, 2))).T
         else:
-            # Single worm: start at origin
-            worm.x = 0.0
-            worm.y = 0.0
+            x, y = rng.normal(0, PATCH_RADIUS, size=(2, size))
+        inside = (cfg.x_min < x) & (x < cfg.x_max) & (cfg.x_min < y) & (y < cfg.x_max)
+        return x[inside], y[inside]
+
+    return propose
+
+def poisson_disk_points(num_worms, x_min, x_max, min_dist, propose, rng=np.random, max_stalls=20):
+    # Place num_worms points at least min_dist apart, drawing candidates from propose(size)
+    # Grid-accelerated dart throwing: cells of min_dist/sqrt(2) hold at most one point, and cells
+    # that share (row % 3, col % 3) cannot conflict, so each of those 9 phases is tested as one batch
+    x_out, y_out = np.empty(num_worms), np.empty(num_worms)
+    count = 0
+    if min_dist <= 0:
+        while count < num_worms:
+            x, y = propose(num_worms - count)
+            x_out[count:count + x.shape[0]], y_out[count:count + x.shape[0]] = x, y
+            count += x.shape[0]
+        return x_out, y_out
+
+    cell_size = min_dist / np.sqrt(2)
+    num_cells = int(np.ceil((x_max - x_min) / cell_size))
+    if num_cells**2 > MAX_PLACEMENT_CELLS:
+        raise ValueError(f"worm_min_dist ({min_dist}) is too small for the placement grid, use 0 to disable it")
+    # Index of the point in every cell, padded by the 2 cells a conflict can reach
+    occupant = np.full((num_cells + 4, num_cells + 4), -1, dtype=np.int64)
+    reach = [(d_row, d_col) for d_row in range(-2, 3) for d_col in range(-2, 3) if abs(d_row * d_col) != 4]
+
+    stalls = 0
+    while count < num_worms:
+        x, y = propose(max(2 * (num_worms - count), 1024))
+        col = np.clip(((x - x_min) // cell_size).astype(np.int64), 0, num_cells - 1) + 2
+        row = np.clip(((y - x_min) // cell_size).astype(np.int64), 0, num_cells - 1) + 2
+        phase = (row % 3) * 3 + col % 3
+        placed_before = count
+
+        for phase_i in range(9):
+            candidates = np.nonzero((phase == phase_i) & (occupant[row, col] < 0))[0]
+            # First candidate of every empty cell
+            _, first = np.unique(row[candidates] * occupant.shape[1] + col[candidates], return_index=True)
+            candidates = candidates[np.sort(first)]
+
+            accept = np.ones(candidates.shape[0], dtype=bool)
+            for d_row, d_col in reach:
+                neighbour = occupant[row[candidates] + d_row, col[candidates] + d_col]
+                near = neighbour >= 0
+                dist_sq = (x_out[neighbour[near]] - x[candidates[near]])**2 + (y_out[neighbour[near]] - y[candidates[near]])**2
+                accept[near] &= dist_sq >= min_dist**2
+
+            candidates = candidates[accept][:num_worms - count]
+            placed = slice(count, count + candidates.shape[0])
+            x_out[placed], y_out[placed] = x[candidates], y[candidates]
+            occupant[row[candidates], col[candidates]] = np.arange(count, count + candidates.shape[0])
+            count += candidates.shape[0]
+            if count == num_worms:
+                break
+
+        stalls = 0 if count > placed_before else stalls + 1
+        if stalls >= max_stalls:
+            raise ValueError(f"Could only place {count} of {num_worms} worms {min_dist} apart, "
+                             f"lower worm_min_dist or num_worms")
+
+    # Phases fill in a fixed order, so shuffle which worm gets which point
+    order = rng.permutation(num_worms)
+    return x_out[order], y_out[order]
+
+def initial_positions(dim, cfg, rng=np.random):
+    # Initial worm positions of the configured initialization mode
+    if cfg.worm_init == "lattice":
+        # A single worm starts at the origin; no lattice is drawn, so the RNG stream matches older runs
+        if cfg.num_worms <= 1:
+            return np.zeros(1), np.zeros(1)
+        coords = generate_points_with_min_distance(
+            cfg.num_worms * 2,
+            shape=(dim, dim),
+            min_dist=10,
+            rng=rng,
+            min_points=cfg.num_worms,
+        )
+        return place_worms(coords, dim, cfg, rng)
+    return poisson_disk_points(cfg.num_worms, cfg.x_min, cfg.x_max, cfg.worm_min_dist,
+                               position_proposal(cfg, rng), rng)
+
+def create_worms(dim, cfg, worm_params, rngs=None):
+    # Create worm population; in ensemble mode every replicate draws from its own RNG
+    replicate_rngs = [np.random] if rngs is None else rngs
+
+    # Positions are drawn before the worm states so each replicate consumes its RNG
+    # in the same order as a single run with its seed
+    positions = [initial_positions(dim, cfg, rng) for rng in replicate_rngs]
+
+    # Worm randomness from per-block streams seeded like the replicates
+    streams = None
+    if cfg.worm_rng == "streams":
+        shape = (cfg.num_worms,) if rngs is None else (len(rngs), cfg.num_worms)
+        streams = Streams.WormStreams(replicate_seeds(cfg), shape, Worms.WormPopulation.variates)
+
+    worms = Worms.WormPopulation(worm_params, cfg.num_worms, rngs, streams)
+    worm_x, worm_y = zip(*positions)
+    worms.x = np.asarray(worm_x[0] if rngs is None else np.stack(worm_x), dtype=worms.dtype)
+    worms.y = np.asarray(worm_y[0] if rngs is None else np.stack(worm_y), dtype=worms.dtype)
 
-        worms.append(worm)
-    
     return worms
 
 def world_objects(cfg_options, world_params):
@@ -192,22 +384,28 @@ def world_objects(cfg_options, world_params):
     # Calculate grid dimension
     dim = len(np.arange(cfg_options.x_min, cfg_options.x_max, cfg_options.dx)) + 1
 
+    # Shared profiler; a disabled one costs a no-op context per phase
+    profiler = Profiler.Profiler(cfg_options.profile)
+
     # Create environment and keeper objects
-    environment = Environment.Environment(world_params["environment"])
-    keeper = Keeper.Keeper(world_params["keeper"])
+    environment = Environment.Environment({**world_params["environment"], "profiler": profiler})
+    if isinstance(world_params["keeper"], list):
+        keeper = Keeper.EnsembleKeeper([Keeper.Keeper({**params, "profiler": profiler})
+                                        for params in world_params["keeper"]])
+    else:
+        keeper = Keeper.Keeper({**world_params["keeper"], "profiler": profiler})
 
-    # Create worm(s)
-    coords = generate_points_with_min_distance(
-        cfg_options.num_worms * 2,
-        shape=(dim, dim),
-        min_dist=10
-    )
-    worms = create_worms(coords, dim, cfg_options, world_params["worm"])
+    # Create worm(s), with one RNG per replicate in ensemble mode
+    rngs = None
+    if cfg_options.num_replicates > 1:
+        rngs = [np.random.RandomState(seed) for seed in replicate_seeds(cfg_options)]
+    worms = create_worms(dim, cfg_options, world_params["worm"], rngs)
 
     world_objs = {
         "environment": environment,
         "worms": worms,
         "keeper": keeper,
+        "profiler": profiler,
     }
 
     return world_objs
\ No newline at end of file
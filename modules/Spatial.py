@@ -0,0 +1,132 @@
+import numpy as np
+
+# Largest cell table of a cell list, over all groups; smaller radii get cells larger than the radius
+MAX_CELLS = 1 << 22
+
+class CellList(object):
+    """
+        Uniform-grid spatial hash
+        -------------------------
+        Points are binned into square cells of `cell_size` over the arena
+        [x_min, x_max]² (points outside are clamped into the edge cells) and
+        sorted by cell, so each cell is one contiguous range of the sorted
+        order. Radius queries and pair searches only visit the cells within
+        reach of the radius, which keeps both roughly O(N) for bounded
+        densities instead of O(N²).
+
+        Points may carry a `group` label (e.g. the replicate in ensemble
+        mode); only points of the same group are ever neighbours. The cell
+        table holds at most MAX_CELLS cells over all groups, so for tiny
+        radii the cells are made coarser than requested.
+    """
+    def __init__(self, x_min, x_max, cell_size):
+        self.x_min = x_min
+        self.x_max = x_max
+        self.min_cell_size = cell_size
+        self.num_points = 0
+        self.__set_cells(1)
+
+    def __set_cells(self, num_groups):
+        """Cells of at least min_cell_size, coarsened until num_groups tables fit in MAX_CELLS"""
+        arena = self.x_max - self.x_min
+        max_cells_axis = max(1, int(np.sqrt(MAX_CELLS // num_groups)))
+        self.num_cells_axis = max(1, int(np.ceil(arena / self.min_cell_size)))
+        self.cell_size = self.min_cell_size
+        if self.num_cells_axis > max_cells_axis:
+            self.num_cells_axis = max_cells_axis
+            self.cell_size = arena / max_cells_axis
+
+    def __cell_coords(self, x, y):
+        """Cell column and row of every point"""
+        last = self.num_cells_axis - 1
+        col = np.clip(((x - self.x_min) // self.cell_size).astype(np.int64), 0, last)
+        row = np.clip(((y - self.x_min) // self.cell_size).astype(np.int64), 0, last)
+        return col, row
+
+    def __cell_id(self, group, row, col):
+        return (group * self.num_cells_axis + row) * self.num_cells_axis + col
+
+    def build(self, x, y, group=None):
+        """Bin the points, given as flat arrays, with one counting sort"""
+        self.x = np.asarray(x, dtype=float).ravel()
+        self.y = np.asarray(y, dtype=float).ravel()
+        self.group = np.zeros(self.x.shape, dtype=np.int64) if group is None else np.asarray(group).ravel()
+        self.num_points = self.x.shape[0]
+        self.num_groups = int(self.group.max()) + 1 if self.num_points else 1
+        self.__set_cells(self.num_groups)
+
+        self.col, self.row = self.__cell_coords(self.x, self.y)
+        cell = self.__cell_id(self.group, self.row, self.col)
+        num_cells = self.num_groups * self.num_cells_axis**2
+        self.order = np.argsort(cell, kind="stable")
+        self.cell_start = np.zeros(num_cells + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell, minlength=num_cells), out=self.cell_start[1:])
+        return self
+
+    def __candidates(self, group, row, col, d_row, d_col):
+        """(source, point) pairs of every source with every point in its cell shifted by (d_row, d_col)"""
+        row, col = row + d_row, col + d_col
+        inside = (row >= 0) & (row < self.num_cells_axis) & (col >= 0) & (col < self.num_cells_axis)
+        source = np.nonzero(inside)[0]
+        cell = self.__cell_id(group[source], row[source], col[source])
+        start = self.cell_start[cell]
+        counts = self.cell_start[cell + 1] - start
+
+        # Expand every source's cell range [start, start + count) into explicit pairs
+        source = np.repeat(source, counts)
+        first = np.repeat(start - np.cumsum(counts) + counts, counts)
+        return source, self.order[first + np.arange(source.shape[0])]
+
+    def __reach(self, radius):
+        return int(np.ceil(radius / self.cell_size))
+
+    def query(self, x, y, radius, group=None):
+        """
+        All points within radius of each query point, as (query index, point index)
+        pairs sorted by query; `group` gives the group of every query point.
+        """
+        x = np.asarray(x, dtype=float).ravel()
+        y = np.asarray(y, dtype=float).ravel()
+        group = np.zeros(x.shape, dtype=np.int64) if group is None else np.broadcast_to(group, x.shape).ravel()
+        col, row = self.__cell_coords(x, y)
+        reach = self.__reach(radius)
+
+        queries, points = [], []
+        for d_row in range(-reach, reach + 1):
+            for d_col in range(-reach, reach + 1):
+                query_i, point_i = self.__candidates(group, row, col, d_row, d_col)
+                close = (self.x[point_i] - x[query_i])**2 + (self.y[point_i] - y[query_i])**2 <= radius**2
+                queries.append(query_i[close])
+                points.append(point_i[close])
+        return self.__sorted_pairs(np.concatenate(queries), np.concatenate(points))
+
+    def pairs(self, radius):
+        """Every unordered pair of built points within radius, as (i, j) index arrays with i < j"""
+        reach = self.__reach(radius)
+        source_sorted = self.order
+        group, row, col = self.group[source_sorted], self.row[source_sorted], self.col[source_sorted]
+
+        first, second = [], []
+        # Half of the neighbouring cells, so every pair of cells is visited once
+        for d_row in range(0, reach + 1):
+            for d_col in range(-reach, reach + 1):
+                if d_row == 0 and d_col < 0:
+                    continue
+                source_i, point_i = self.__candidates(group, row, col, d_row, d_col)
+                source_i = source_sorted[source_i]
+                close = (self.x[point_i] - self.x[source_i])**2 + (self.y[point_i] - self.y[source_i])**2 <= radius**2
+                if d_row == 0 and d_col == 0:
+                    close &= source_i < point_i
+                first.append(np.minimum(source_i[close], point_i[close]))
+                second.append(np.maximum(source_i[close], point_i[close]))
+        return self.__sorted_pairs(np.concatenate(first), np.concatenate(second))
+
+    def neighbour_counts(self, radius):
+        """Number of other built points within radius of every point"""
+        first, second = self.pairs(radius)
+        return (np.bincount(first, minlength=self.num_points) +
+                np.bincount(second, minlength=self.num_points))
+
+    def __sorted_pairs(self, first, second):
+        order = np.lexsort((second, first))
+        return first[order], second[order]
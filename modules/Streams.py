@@ -0,0 +1,103 @@
+import numpy as np
+
+# Worms per random stream; part of the stream layout, so changing it changes results
+BLOCK_SIZE = 1024
+# Values per refill of one variate, across all replicates and blocks
+CHUNK_VALUES = 1 << 20
+
+class WormStreams(object):
+    """
+        Per-block random streams for a worm population
+        ----------------------------------------------
+        Every variate (e.g. "turn_noise") of every block of BLOCK_SIZE worms
+        has its own PCG64 stream, addressed by the spawn key (variate, block)
+        under the SeedSequence of the run's seed. Each `draw` returns one
+        value per worm slot, whether or not the caller uses it, so worm i
+        always gets value i % BLOCK_SIZE of its block's next row: results do
+        not depend on the number of worms, on masks, on chunking or on how
+        worms are split across workers.
+
+        Rows are generated in large chunks; Generator fills arrays
+        sequentially, so a chunk holds exactly the rows that row-by-row
+        draws would give. A checkpoint stores the generator states from
+        before the current chunk and how many of its rows were used.
+    """
+    # Generator methods drawing the standard variate of each kind
+    samplers = {
+        "uniform"     : "random",
+        "normal"      : "standard_normal",
+        "exponential" : "standard_exponential",
+    }
+
+    def __init__(self, seeds, shape, variates):
+        self.seeds = list(seeds)
+        self.shape = shape
+        self.num_worms = shape[-1]
+        self.variates = variates
+        self.num_blocks = -(-self.num_worms // BLOCK_SIZE)
+        self.chunk_rows = max(1, CHUNK_VALUES // (len(self.seeds) * self.num_blocks * BLOCK_SIZE))
+        self.__init_generators()
+
+    def __init_generators(self):
+        """One generator per replicate and block of every variate, with empty buffers"""
+        self.generators = {}
+        self.buffers = {}
+        self.cursors = {}
+        self.chunk_states = {}
+        for variate_i, variate in enumerate(self.variates):
+            self.generators[variate] = [
+                np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=(variate_i, block))))
+                for seed in self.seeds for block in range(self.num_blocks)
+            ]
+            self.buffers[variate] = None
+            self.cursors[variate] = self.chunk_rows
+            self.chunk_states[variate] = self.__states(variate)
+
+    def __states(self, variate):
+        return [generator.bit_generator.state for generator in self.generators[variate]]
+
+    def __refill(self, variate):
+        """Generate the next chunk of rows of every stream of a variate"""
+        self.chunk_states[variate] = self.__states(variate)
+        sampler = self.samplers[self.variates[variate]]
+        # (replicate * block, rows, BLOCK_SIZE): every stream fills its own contiguous part
+        if self.buffers[variate] is None:
+            self.buffers[variate] = np.empty((len(self.generators[variate]), self.chunk_rows, BLOCK_SIZE))
+        for generator, out in zip(self.generators[variate], self.buffers[variate]):
+            getattr(generator, sampler)(out=out)
+        self.cursors[variate] = 0
+
+    def draw(self, variate):
+        """Next row of a variate: one standard value per worm, shaped like the worm state"""
+        if self.cursors[variate] == self.chunk_rows:
+            self.__refill(variate)
+        row = self.buffers[variate][:, self.cursors[variate]].reshape(len(self.seeds), -1)
+        self.cursors[variate] += 1
+        return row[:, :self.num_worms].reshape(self.shape)
+
+    def checkpoint_state(self):
+        """PCG64 states from before the current chunks (128-bit words split in halves) and rows used"""
+        words = []
+        for variate in self.variates:
+            words.append([[state["state"]["state"] >> 64, state["state"]["state"] & (2**64 - 1),
+                           state["state"]["inc"] >> 64, state["state"]["inc"] & (2**64 - 1),
+                           state["has_uint32"], state["uinteger"]]
+                          for state in self.chunk_states[variate]])
+        used = [0 if self.buffers[variate] is None else self.cursors[variate] for variate in self.variates]
+        return {"stream_states": np.array(words, dtype=np.uint64), "stream_rows_used": np.array(used)}
+
+    def restore_state(self, state):
+        """Regenerate the chunks in use at checkpoint time and skip the rows already used"""
+        for variate, words, used in zip(self.variates, state["stream_states"], state["stream_rows_used"]):
+            for generator, word in zip(self.generators[variate], words.tolist()):
+                generator.bit_generator.state = {
+                    "bit_generator": "PCG64",
+                    "state": {"state": (word[0] << 64) | word[1], "inc": (word[2] << 64) | word[3]},
+                    "has_uint32": word[4],
+                    "uinteger": word[5],
+                }
+            self.cursors[variate] = self.chunk_rows
+            self.chunk_states[variate] = self.__states(variate)
+            if used:
+                self.__refill(variate)
+                self.cursors[variate] = int(used)
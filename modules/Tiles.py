@@ -0,0 +1,77 @@
+import numpy as np
+
+class ActiveTiles(object):
+    """
+        Active-region tracking for the bacteria map
+        -------------------------------------------
+        The grid is split into square tiles. A tile whose cells are all
+        exactly 0 or all exactly 1, with all neighbouring tiles at the same
+        value, has zero Laplacian and zero logistic growth, so a stencil step
+        leaves it unchanged. Only the remaining (active) tiles are updated.
+
+        `tile_value` caches, per tile, that uniform value (NaN when the tile
+        is not uniformly 0 or 1). Only updated tiles can change, so only they
+        are re-measured after a step; deposits invalidate the tiles they touch.
+    """
+    def __init__(self, shape, tile_size):
+        self.shape = shape
+        self.tile_size = tile_size
+        self.tiles_shape = (-(-shape[0] // tile_size), -(-shape[1] // tile_size))
+        self.tile_value = np.full(self.tiles_shape, np.nan)
+        self.active = np.ones(self.tiles_shape, dtype=bool)
+
+    def __tile_runs(self, mask):
+        """Horizontal runs of selected tiles as (tile row, first tile col, last tile col + 1)"""
+        padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+        padded[:, 1:-1] = mask
+        edges = np.diff(padded, axis=1)
+        starts = np.nonzero(edges == 1)
+        stops = np.nonzero(edges == -1)
+        return zip(starts[0], starts[1], stops[1])
+
+    def __run_slices(self, tile_row, tile_col_start, tile_col_stop):
+        """Grid slices covered by a run of tiles"""
+        size = self.tile_size
+        rows = slice(int(tile_row) * size, min((int(tile_row) + 1) * size, self.shape[0]))
+        cols = slice(int(tile_col_start) * size, min(int(tile_col_stop) * size, self.shape[1]))
+        return rows, cols
+
+    def __measure(self, field, mask):
+        """Recompute the cached uniform value of the selected tiles"""
+        for tile_row, col_start, col_stop in self.__tile_runs(mask):
+            rows, cols = self.__run_slices(tile_row, col_start, col_stop)
+            region = field[..., rows, cols].reshape(-1, cols.stop - cols.start)
+            tile_starts = np.arange(0, cols.stop - cols.start, self.tile_size)
+            low = np.minimum.reduceat(region.min(axis=0), tile_starts)
+            high = np.maximum.reduceat(region.max(axis=0), tile_starts)
+            uniform = (low == high) & ((low == 0) | (low == 1))
+            self.tile_value[tile_row, col_start:col_stop] = np.where(uniform, low, np.nan)
+
+    def __refresh_active(self):
+        """A tile is active unless it and all of its neighbours share a uniform 0 or 1"""
+        padded = np.pad(self.tile_value, 1, mode='edge')
+        quiescent = ~np.isnan(self.tile_value)
+        height, width = self.tiles_shape
+        for shift_row in range(3):
+            for shift_col in range(3):
+                quiescent &= padded[shift_row:shift_row + height, shift_col:shift_col + width] == self.tile_value
+        self.active = ~quiescent
+
+    def reset(self, field):
+        """Measure every tile of field"""
+        self.__measure(field, np.ones(self.tiles_shape, dtype=bool))
+        self.__refresh_active()
+
+    def blocks(self):
+        """Grid blocks (row slice, col slice) covering all active tiles"""
+        return [self.__run_slices(*run) for run in self.__tile_runs(self.active)]
+
+    def mark(self, rows, cols):
+        """Invalidate the tiles containing the given grid cells"""
+        self.tile_value[rows // self.tile_size, cols // self.tile_size] = np.nan
+        self.__refresh_active()
+
+    def update(self, field):
+        """Re-measure the tiles just updated and recompute the active set"""
+        self.__measure(field, self.active)
+        self.__refresh_active()
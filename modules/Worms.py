@@ -1,5 +1,7 @@
 import numpy as np
 
+import modules.Spatial as Spatial
+
 class Worm(object):
     def __init__(self, params):
         self.__set_params(params)
@@ -106,4 +108,228 @@ class Worm(object):
         self.__update_movement(environment)
         self.__update_state()
         self.__drop_bacteria(environment)
-        self.timestep += 1
\ No newline at end of file
+        self.timestep += 1
+
+# State encoding shared with the Keeper
+RUN = 0
+TUMBLE = 1
+
+# Per-worm arrays of a WormPopulation saved in checkpoints
+STATE_FIELDS = ["x", "y", "angle", "state", "state_timer",
+                "run_duration", "tumble_duration", "next_drop_timestep"]
+
+class WormPopulation(object):
+    """
+        Struct-of-arrays worm population
+        ---------------------------------
+        Holds position, heading and run/tumble state of every worm as NumPy
+        arrays and advances all of them with one batched call per timestep.
+        Follows the same run/tumble, boundary and drop logic as Worm.step.
+
+        In ensemble mode (`rngs` given, one per replicate) every array has
+        shape (num_replicates, num_worms) and each replicate draws from its
+        own RNG, in the same order as a single run with that RNG.
+
+        With `streams` (see Streams.WormStreams) every variate is drawn for
+        all worms from per-block Generator streams instead, so a worm's
+        randomness does not depend on the population size or on which
+        worms happen to need a value.
+    """
+    # Random variates of the worm model and their distribution (stream kind and legacy sampler)
+    variates = {
+        "angle"           : "uniform",
+        "turn_noise"      : "normal",
+        "run_duration"    : "exponential",
+        "tumble_duration" : "exponential",
+    }
+
+    def __init__(self, params, num_worms, rngs=None, streams=None):
+        self.precision = "float64"
+        self.__set_params(params)
+        self.dtype = np.dtype(self.precision)
+        self.num_worms = num_worms
+        self.rngs = rngs
+        self.streams = streams
+        self.shape = (num_worms,) if rngs is None else (len(rngs), num_worms)
+        self.__init_position()
+        self.__init_conditions()
+
+        # Neighbour cell list and the position arrays and radius it was built for
+        self.__neighbour_cells = None
+        self.__neighbour_key = (None, None, None)
+
+    def __len__(self):
+        return self.num_worms
+
+    def __set_params(self, params):
+        """Store all parameters as instance variables"""
+        for key, val in params.items():
+            self.__dict__[key] = val
+
+    def __init_position(self):
+        """Initialize all worm positions at origin"""
+        self.num = np.arange(self.num_worms)
+        self.x = np.zeros(self.shape, dtype=self.dtype)
+        self.y = np.zeros(self.shape, dtype=self.dtype)
+
+    def __init_conditions(self):
+        """Initialize worm state arrays"""
+        every_worm = np.ones(self.shape, dtype=bool)
+        self.angle = self.__draw("angle", every_worm).reshape(self.shape).astype(self.dtype, copy=False)
+        self.timestep = 0
+
+        # Run and tumble state
+        self.state = np.full(self.shape, RUN, dtype=np.int8)
+        self.state_timer = np.zeros(self.shape, dtype=int)
+        self.run_duration = self.__sample_run_duration(every_worm).reshape(self.shape).astype(self.dtype, copy=False)
+        self.tumble_duration = self.__sample_tumble_duration(every_worm).reshape(self.shape).astype(self.dtype, copy=False)
+
+        # Bacteria drop (fixed interval)
+        self.next_drop_timestep = np.zeros(self.shape, dtype=int)
+
+    def __variate_params(self, variate):
+        """Location and scale of a variate"""
+        return {
+            "angle"           : (0, 2 * np.pi),
+            "turn_noise"      : (0, self.worm_turn_noise),
+            "run_duration"    : (0, self.worm_mean_run_duration),
+            "tumble_duration" : (0, self.worm_mean_tumble_duration),
+        }[variate]
+
+    def __draw(self, variate, mask):
+        """One sample per selected worm, in mask order, from the streams or each replicate's own RNG"""
+        loc, scale = self.__variate_params(variate)
+        if self.streams is not None:
+            return loc + scale * self.streams.draw(variate)[mask]
+
+        # Legacy samplers: uniform(low, high), normal(loc, scale), exponential(scale)
+        sampler = self.variates[variate]
+        args = {"uniform": (loc, loc + scale), "normal": (loc, scale), "exponential": (scale,)}[sampler]
+        if self.rngs is None:
+            return getattr(np.random, sampler)(*args, size=np.count_nonzero(mask))
+        return np.concatenate([getattr(rng, sampler)(*args, size=np.count_nonzero(replicate_mask))
+                               for rng, replicate_mask in zip(self.rngs, mask)])
+
+    def __sample_run_duration(self, mask):
+        """Sample run durations of the selected worms from exponential distribution"""
+        return self.__draw("run_duration", mask)
+
+    def __sample_tumble_duration(self, mask):
+        """Sample tumble durations of the selected worms from exponential distribution"""
+        return self.__draw("tumble_duration", mask)
+
+    def __check_arena_boundary(self, environment, coord):
+        """Check which coordinates are within bounds"""
+        return (environment.x_min < coord) & (coord < environment.x_max)
+
+    def __update_movement(self, environment, running):
+        """Update positions of running worms, tumbling worms stay in place"""
+        next_x = np.where(running, self.x + self.worm_step_size * np.cos(self.angle), self.x)
+        next_y = np.where(running, self.y + self.worm_step_size * np.sin(self.angle), self.y)
+
+        # Check arena boundaries per coordinate
+        move_in_x = self.__check_arena_boundary(environment, next_x)
+        move_in_y = self.__check_arena_boundary(environment, next_y)
+
+        self.x = np.where(move_in_x, next_x, self.x)
+        self.y = np.where(move_in_y, next_y, self.y)
+
+    def __update_angle(self, running):
+        """Update headings: small noise while running, random turn while tumbling"""
+        tumbling = ~running
+        self.angle[running] += self.__draw("turn_noise", running)
+        self.angle[tumbling] = self.__draw("angle", tumbling)
+
+        # Normalize angle to [0, 2pi]
+        self.angle %= (2 * np.pi)
+
+    def __update_state(self, running):
+        """Update state timers and switch states whose duration elapsed"""
+        self.state_timer += 1
+
+        to_tumble = running & (self.state_timer >= self.run_duration)
+        to_run = ~running & (self.state_timer >= self.tumble_duration)
+
+        self.state[to_tumble] = TUMBLE
+        self.tumble_duration[to_tumble] = self.__sample_tumble_duration(to_tumble)
+
+        self.state[to_run] = RUN
+        self.run_duration[to_run] = self.__sample_run_duration(to_run)
+
+        self.state_timer[to_tumble | to_run] = 0
+
+    def __drop_bacteria(self, environment):
+        """Drop bacteria sources at the locations of worms whose drop is due"""
+        if not self.bacteria_enabled:
+            return
+        dropping = self.timestep >= self.next_drop_timestep
+        if np.any(dropping):
+            # In ensemble mode each drop goes to its own replicate's map
+            replicate = np.nonzero(dropping)[0] if self.rngs is not None else None
+            environment.add_bacteria_source(self.x[dropping], self.y[dropping], self.bacteria_amount, replicate)
+        self.next_drop_timestep[dropping] += int(self.bacteria_drop_interval)
+
+    def step(self, environment):
+        """Single time step update for every worm"""
+        running = self.state == RUN
+        self.__update_angle(running)
+        self.__update_movement(environment, running)
+        self.__update_state(running)
+        self.__drop_bacteria(environment)
+        self.timestep += 1
+
+    def __neighbour_index(self, environment, radius):
+        """Cell list over the current positions, rebuilt only after the worms moved or the radius changed"""
+        x, y, cell_radius = self.__neighbour_key
+        if x is not self.x or y is not self.y or cell_radius != radius:
+            group = None if self.rngs is None else np.repeat(np.arange(self.shape[0]), self.num_worms)
+            self.__neighbour_cells = Spatial.CellList(environment.x_min, environment.x_max, radius)
+            self.__neighbour_cells.build(self.x, self.y, group)
+            self.__neighbour_key = (self.x, self.y, radius)
+        return self.__neighbour_cells
+
+    def neighbour_pairs(self, environment, radius):
+        """
+        Pairs of worms closer than radius as index arrays (i, j) with i < j,
+        or (replicate, i, j) in ensemble mode
+        """
+        first, second = self.__neighbour_index(environment, radius).pairs(radius)
+        if self.rngs is None:
+            return first, second
+        replicate, first = np.divmod(first, self.num_worms)
+        return replicate, first, second % self.num_worms
+
+    def neighbour_counts(self, environment, radius):
+        """Number of other worms within radius of every worm"""
+        return self.__neighbour_index(environment, radius).neighbour_counts(radius).reshape(self.shape)
+
+    def __replicate_rngs(self):
+        """RNGs whose state belongs to this population (the global one outside ensemble mode)"""
+        return [np.random] if self.rngs is None else self.rngs
+
+    def checkpoint_state(self):
+        """Arrays needed to resume the population exactly, including RNG state"""
+        state = {field: getattr(self, field) for field in STATE_FIELDS}
+        state["timestep"] = np.array(self.timestep)
+
+        # Legacy MT19937 state: (name, keys, pos, has_gauss, cached_gaussian)
+        rng_states = [rng.get_state() for rng in self.__replicate_rngs()]
+        state["rng_keys"] = np.stack([rng_state[1] for rng_state in rng_states])
+        state["rng_pos"] = np.array([rng_state[2] for rng_state in rng_states])
+        state["rng_has_gauss"] = np.array([rng_state[3] for rng_state in rng_states])
+        state["rng_cached_gaussian"] = np.array([rng_state[4] for rng_state in rng_states])
+        if self.streams is not None:
+            state.update(self.streams.checkpoint_state())
+        return state
+
+    def restore_state(self, state):
+        """Restore worm and RNG state saved by checkpoint_state"""
+        for field in STATE_FIELDS:
+            setattr(self, field, state[field].copy())
+        self.timestep = int(state["timestep"])
+
+        for rng_i, rng in enumerate(self.__replicate_rngs()):
+            rng.set_state(("MT19937", state["rng_keys"][rng_i], int(state["rng_pos"][rng_i]),
+                           int(state["rng_has_gauss"][rng_i]), float(state["rng_cached_gaussian"][rng_i])))
+        if self.streams is not None:
+            self.streams.restore_state(state)
@@ -1,11 +1,27 @@
 import os
+import sys
 import glob
+import json
+import time
+import signal
+import argparse
+import traceback
+import contextlib
+import multiprocessing
 from subprocess import call
 
+import main
+import modules.Setup as Setup
+import modules.Cache as Cache
 import config.config_src as config_src
 
-PY_FILE = "main.py"
 BASE_EXPERIMENT_DIR = "experiments"
+MANIFEST_NAME = "sweep_manifest.json"
+
+def setup_opts():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of simulations to run in parallel')
+    return parser.parse_args()
 
 def run_cfg_generator(base_dir):
     cfg_files_dir = os.path.join(base_dir, "config", "files")
@@ -13,13 +29,115 @@ def run_cfg_generator(base_dir):
     call(["python", script_path, "--config_dir", cfg_files_dir])
     return cfg_files_dir
 
-def run_search(base_dir, cfg_files_dir, experiment_dir):
-    cfg_files = glob.glob(f"{cfg_files_dir}/*")
+def init_worker():
+    # Let the parent process handle Ctrl-C and shut the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_experiment(cfg_file, experiment_dir):
+    # Run one config in this (warm) process, logging its output and capturing failures
+    cfg_name = os.path.basename(cfg_file).replace('.cfg', '')
+    log_dir = os.path.join(experiment_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    log_path = os.path.join(log_dir, f"{cfg_name}.log")
+
+    record = {"cfg_file": cfg_file, "log": log_path, "model_dir": None, "error": None}
+    start = time.time()
+    with open(log_path, "w") as log_file, contextlib.redirect_stdout(log_file):
+        try:
+            record["model_dir"], interrupted = main.run(["--base_dir", experiment_dir, "--file", cfg_file])
+            record["status"] = "interrupted" if interrupted else "completed"
+        # argparse exits on an invalid config; that fails this run, not the sweep (or a pool worker)
+        except (Exception, SystemExit):
+            record["status"] = "failed"
+            record["error"] = traceback.format_exc()
+            log_file.write(record["error"])
+    record["duration"] = time.time() - start
+    return record
+
+def run_task(task):
+    return run_experiment(*task)
+
+def write_manifest(experiment_dir, records):
+    # Rewrite the manifest of finished runs; replace atomically so it is never half written
+    manifest_path = os.path.join(experiment_dir, MANIFEST_NAME)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as outfile:
+        json.dump(sorted(records, key=lambda record: record["cfg_file"]), outfile, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def cached_record(cfg_file, experiment_dir, index):
+    # Record of a config whose complete results are in the cache index, or None if it must run
+    # A config that does not parse is run anyway, so it fails and is recorded like any other failure
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+            cfg = Setup.config_options(["--base_dir", experiment_dir, "--file", cfg_file])
+    except SystemExit:
+        return None
+    model_dir = Cache.lookup(index, cfg, Setup.replicate_seeds(cfg))
+    if model_dir is None:
+        return None
+    return {"cfg_file": cfg_file, "log": None, "model_dir": model_dir, "error": None,
+            "status": "cached", "duration": 0.0}
+
+def print_progress(records, num_runs, num_cached, start):
+    # Progress line with failures and an ETA from the mean time per finished run
+    num_done = len(records) - num_cached
+    num_failed = sum(record["status"] == "failed" for record in records)
+    elapsed = time.time() - start
+    eta = elapsed / max(num_done, 1) * (num_runs - num_done)
+    sys.stdout.write(f"\r[{num_done}/{num_runs}] cached: {num_cached} -- failed: {num_failed} -- "
+                     f"elapsed: {elapsed:.0f}s -- ETA: {eta:.0f}s")
+    sys.stdout.flush()
 
-    for cfg_i, cfg_file in enumerate(cfg_files):
-        call(["python", f"{PY_FILE}", "--base_dir", f"{experiment_dir}", "--file", f"{cfg_file}"])
+def run_search(base_dir, cfg_files_dir, experiment_dir, jobs=1):
+    cfg_files = sorted(glob.glob(f"{cfg_files_dir}/*"))
+    os.makedirs(experiment_dir, exist_ok=True)
+
+    # Configs with complete results from earlier sweeps are not run again
+    index = Cache.rebuild_index(experiment_dir)
+    records, tasks = [], []
+    for cfg_file in cfg_files:
+        record = cached_record(cfg_file, experiment_dir, index)
+        if record is None:
+            tasks.append((cfg_file, experiment_dir))
+        else:
+            records.append(record)
+    num_cached = len(records)
+    print(f"{num_cached} of {len(cfg_files)} configs cached, running {len(tasks)}")
+    write_manifest(experiment_dir, records)
+
+    start = time.time()
+
+    if jobs <= 1:
+        results = (run_experiment(*task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs, initializer=init_worker)
+        results = pool.imap_unordered(run_task, tasks)
+
+    try:
+        for record in results:
+            records.append(record)
+            write_manifest(experiment_dir, records)
+            print_progress(records, len(tasks), num_cached, start)
+            # A run stopped by Ctrl-C is recorded, then the sweep stops too
+            if record["status"] == "interrupted":
+                raise KeyboardInterrupt
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        # Workers update the index concurrently; rebuild it from the completion markers
+        Cache.rebuild_index(experiment_dir)
+
+    failed = [record for record in records if record["status"] == "failed"]
+    for record in failed:
+        print(f"\n ** {record['cfg_file']} failed, see {record['log']}")
+    return records
 
 if __name__ == '__main__':
+    opts = setup_opts()
+
     # Set base dir
     base_dir = ""
 
@@ -31,12 +149,12 @@ if __name__ == '__main__':
 
     # Run simulation
     print("\n---------- Simulating worm movement ----------")
-    print(f"Parameters: N={N}")
+    print(f"Parameters: N={N}, jobs={opts.jobs}")
     try:
-        run_search(base_dir, cfg_files_dir, BASE_EXPERIMENT_DIR)
+        run_search(base_dir, cfg_files_dir, BASE_EXPERIMENT_DIR, opts.jobs)
         print("\nFin.\n")
     except KeyboardInterrupt:
         print("\nCancelling experiments.")
     except Exception as e:
         print("\n ** Exception Occurred")
-        print(e)
\ No newline at end of file
+        print(e)
@@ -0,0 +1,95 @@
+import os
+import sys
+
+import h5py
+import numpy as np
+import pytest
+
+# Run from anywhere: the simulation modules live in the repository root
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import main
+import modules.Cache as Cache
+import modules.Stencil as Stencil
+import modules.Worms as Worms
+from modules.Environment import Environment
+
+# Tiny run: 61 x 61 grid, 80 worm steps
+SIM_ARGS = ["--file", os.path.join(ROOT_DIR, "config", "files", "exp_1.cfg"), "--verbose", "",
+            "--num_worms", "5", "--dx", "0.05", "--t_max", "0.002", "--flush_every", "7"]
+
+# Tiny grid for the PDE backends: 61 x 61 cells, 3 replicates
+GRID = dict(x_min=-1.5, x_max=1.5, dx=0.05, t_min=0, t_max=0.01, dt=2.5e-5, num_replicates=3)
+
+needs_numba = pytest.mark.skipif(Stencil.numba is None, reason="numba is not installed")
+
+def read_outputs(model_dir):
+    # Every dataset of both HDF5 files of a run
+    outputs = {}
+    for name in ("worm_hist.h5", "environment_hist.h5"):
+        with h5py.File(os.path.join(model_dir, name), "r") as infile:
+            outputs.update({f"{name}/{key}": infile[key][:] for key in infile})
+    return outputs
+
+def evolve(params, num_steps=120, seed=3):
+    # Final bacteria map after PDE steps with deposits at random places every 20 steps
+    environment = Environment(dict(GRID, **params))
+    rng = np.random.default_rng(seed)
+    for step_i in range(num_steps):
+        if step_i % 20 == 0:
+            for replicate in range(GRID["num_replicates"]):
+                environment.add_bacteria_source(rng.uniform(-1.5, 1.5, 4), rng.uniform(-1.5, 1.5, 4), 1, replicate)
+        environment.update_bacteria_map()
+    bacteria_map = np.array(environment.bacteria_map)
+    if hasattr(environment.solver, "close"):
+        environment.solver.close()
+    return bacteria_map
+
+def test_resume_is_identical_to_uninterrupted_run(tmp_path, monkeypatch, capsys):
+    full_dir, interrupted = main.run(SIM_ARGS + ["--base_dir", str(tmp_path / "full")])
+    assert not interrupted
+
+    # Ctrl-C after 50 worm steps, past the checkpoint at step 40 and several flushes
+    step = Worms.WormPopulation.step
+    calls = []
+    def interrupting_step(self, environment):
+        calls.append(None)
+        if len(calls) > 50:
+            raise KeyboardInterrupt
+        step(self, environment)
+    monkeypatch.setattr(Worms.WormPopulation, "step", interrupting_step)
+    resume_args = SIM_ARGS + ["--base_dir", str(tmp_path / "resumed"), "--checkpoint_every", "20"]
+    model_dir, interrupted = main.run(resume_args)
+    assert interrupted and not Cache.is_complete(model_dir)
+
+    monkeypatch.setattr(Worms.WormPopulation, "step", step)
+    capsys.readouterr()
+    model_dir, interrupted = main.run(resume_args + ["--resume"])
+    assert not interrupted and Cache.is_complete(model_dir)
+    assert "Resuming from timestep 41" in capsys.readouterr().out
+
+    expected, resumed = read_outputs(full_dir), read_outputs(model_dir)
+    assert expected.keys() == resumed.keys()
+    for key in expected:
+        np.testing.assert_array_equal(resumed[key], expected[key], err_msg=key)
+
+@pytest.mark.parametrize("params", [
+    pytest.param({"pde_backend": "numba"}, marks=needs_numba, id="numba"),
+    pytest.param({"active_tile_size": 8}, id="tiles"),
+    pytest.param({"pde_threads": 2}, id="threads"),
+    pytest.param({"pde_processes": 2}, id="processes"),
+    pytest.param({"pde_processes": 2, "pde_threads": 2}, id="processes-threads"),
+])
+def test_backends_are_identical(params):
+    reference = evolve({"pde_backend": "numpy", "active_tile_size": 0})
+    candidate = evolve(dict({"pde_backend": "numpy", "active_tile_size": 0}, **params))
+    assert candidate.dtype == reference.dtype
+    np.testing.assert_array_equal(candidate, reference)
+
+@needs_numba
+def test_float32_backends_are_identical():
+    reference = evolve({"pde_backend": "numpy", "active_tile_size": 0, "precision": "float32"})
+    candidate = evolve({"pde_backend": "numba", "active_tile_size": 0, "precision": "float32"})
+    assert reference.dtype == np.float32
+    np.testing.assert_array_equal(candidate, reference)
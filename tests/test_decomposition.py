@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# Run from anywhere: the simulation modules live in the repository root
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import modules.Stencil as Stencil
+from modules.Environment import Environment
+
+GRID = dict(x_min=-1.5, x_max=1.5, dx=0.05, t_min=0, t_max=0.01, dt=2.5e-5, pde_backend="numpy")
+
+def test_failing_strip_worker_raises_instead_of_hanging(monkeypatch):
+    # Workers are forked after the patch, so the last strip (rows 41-61 plus its halo) raises on its first step;
+    # it is the only strip with a halo row above its block and none below
+    compute = Stencil.StencilEngine.compute
+    def failing_compute(self, field, blocks=None):
+        if blocks is not None and blocks[0][0].start > 0 and blocks[0][0].stop == field.shape[-2]:
+            raise ValueError("strip failure")
+        compute(self, field, blocks)
+    monkeypatch.setattr(Stencil.StencilEngine, "compute", failing_compute)
+
+    environment = Environment(dict(GRID, pde_processes=3))
+    try:
+        with pytest.raises(RuntimeError, match="rows 41-61"):
+            for _ in range(3):
+                environment.update_bacteria_map()
+    finally:
+        environment.solver.close()
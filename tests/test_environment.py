@@ -0,0 +1,33 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# Run from anywhere: the simulation modules live in the repository root
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import modules.Environment as Environment
+
+GRID = dict(x_min=-1.5, x_max=1.5, dx=0.02, t_min=0, t_max=0.01, dt=2.5e-5)
+
+@pytest.mark.parametrize("num_replicates, per_replicate", [(1, False), (3, False), (3, True)])
+@pytest.mark.parametrize("chunk_cells", [1, 1000, Environment.DEPOSIT_CHUNK_CELLS])
+def test_chunked_deposit_equals_per_source_loop(monkeypatch, chunk_cells, num_replicates, per_replicate):
+    # Overlapping sources, some on the arena edge, with amounts that saturate some cells
+    rng = np.random.default_rng(1)
+    x, y = rng.uniform(-1.6, 1.6, (2, 300))
+    amount = rng.uniform(0, 0.5, 300)
+    replicate = rng.integers(0, num_replicates, 300) if per_replicate else None
+
+    monkeypatch.setattr(Environment, "DEPOSIT_CHUNK_CELLS", chunk_cells)
+    batched = Environment.Environment(dict(GRID, num_replicates=num_replicates))
+    batched.add_bacteria_source(x, y, amount, replicate)
+
+    looped = Environment.Environment(dict(GRID, num_replicates=num_replicates))
+    for i in range(x.shape[0]):
+        looped.add_bacteria_source(x[i], y[i], amount[i], None if replicate is None else replicate[i])
+
+    assert batched.bacteria_map.max() == 1
+    np.testing.assert_allclose(batched.bacteria_map, looped.bacteria_map, rtol=1e-12, atol=1e-15)
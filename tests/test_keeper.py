@@ -0,0 +1,33 @@
+import os
+import sys
+
+import numpy as np
+
+# Run from anywhere: the simulation modules live in the repository root
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import modules.Estimator as Estimator
+from modules.Environment import Environment
+from modules.Keeper import Keeper
+
+GRID = dict(x_min=-1.5, x_max=1.5, dx=0.05, t_min=0, t_max=0.01, dt=2.5e-5)
+
+def test_snapshot_roi_on_grid_lines_keeps_its_edge_cells(tmp_path):
+    # Bounds exactly on grid lines, where the float axis is a few ulps off the bound
+    environment = Environment(GRID)
+    roi = (-0.9, 0.3, -0.45, 1.2)
+    params = dict(worm_path=str(tmp_path / "worm_hist.h5"), environment_path=str(tmp_path / "environment_hist.h5"),
+                  sleeping=False, snapshot_roi=roi)
+    keeper = Keeper(params)
+    keeper.measure_environment(environment, 0)
+
+    # Columns 12-36 and rows 21-54 of the grid, both edges included
+    assert (keeper.snapshot_cols.start, keeper.snapshot_cols.stop) == (12, 37)
+    assert (keeper.snapshot_rows.start, keeper.snapshot_rows.stop) == (21, 55)
+    np.testing.assert_allclose(environment.x_axis[keeper.snapshot_cols][[0, -1]], roi[:2])
+    np.testing.assert_allclose(environment.y_axis[keeper.snapshot_rows][[0, -1]], roi[2:])
+
+    # The estimator sizes the same window
+    keeper_params = dict(params, snapshot_downsample=1)
+    assert Estimator.snapshot_window(keeper_params, GRID, environment.grid_shape[0]) == (34, 25)
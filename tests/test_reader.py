@@ -0,0 +1,42 @@
+import os
+import sys
+
+import h5py
+import numpy as np
+import pytest
+
+# Run from anywhere: the simulation modules live in the repository root
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import modules.Reader as Reader
+
+NUM_FRAMES, NUM_WORMS = 40, 6
+
+def write_irregular_records(path, rng):
+    # Records of every frame in shuffled worm order, with some records missing
+    t, worm_i = np.meshgrid(np.arange(NUM_FRAMES), np.arange(NUM_WORMS), indexing="ij")
+    order = np.concatenate([frame * NUM_WORMS + rng.permutation(NUM_WORMS) for frame in range(NUM_FRAMES)])
+    kept = order[rng.uniform(size=order.shape[0]) > 0.1]
+    x = rng.uniform(-1.5, 1.5, (NUM_FRAMES, NUM_WORMS))
+    with h5py.File(path, "w") as outfile:
+        outfile["t"] = t.ravel()[kept]
+        outfile["worm_i"] = worm_i.ravel()[kept]
+        outfile["x"] = x.ravel()[kept]
+    # Expected (frames, worms) table with NaN for missing records
+    expected = np.full(NUM_FRAMES * NUM_WORMS, np.nan)
+    expected[kept] = x.ravel()[kept]
+    return expected.reshape(NUM_FRAMES, NUM_WORMS)
+
+@pytest.mark.parametrize("span_factor", [0, 2, NUM_FRAMES * NUM_WORMS])
+def test_irregular_records_are_gathered_exactly(tmp_path, monkeypatch, span_factor):
+    # Factor 0 always reads just the requested rows, the largest always reads one contiguous span
+    monkeypatch.setattr(Reader, "GATHER_SPAN_FACTOR", span_factor)
+    expected = write_irregular_records(tmp_path / "worm_hist.h5", np.random.default_rng(4))
+
+    with Reader.ExperimentReader(str(tmp_path)) as reader:
+        assert reader.record_index is not None
+        for worm_num in range(NUM_WORMS):
+            np.testing.assert_array_equal(reader.worm(worm_num, ("x",))["x"], expected[:, worm_num])
+        np.testing.assert_array_equal(reader.worm_frames(5, 17, ("x",))["x"], expected[5:17])
+        np.testing.assert_array_equal(reader.worm_frames_at([1, 2, 9, 30], ("x",))["x"], expected[[1, 2, 9, 30]])
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import numpy as np
+
+# Run from anywhere: the simulation modules live in the repository root
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import modules.Worms as Worms
+from modules.Environment import Environment
+
+GRID = dict(x_min=-1.5, x_max=1.5, dx=0.05, t_min=0, t_max=0.01, dt=2.5e-5)
+WORM_PARAMS = dict(worm_turn_noise=0.1, worm_mean_run_duration=1.0, worm_mean_tumble_duration=0.1)
+
+def brute_force_counts(x, y, radius):
+    # Neighbours of every worm within radius, by comparing all pairs
+    dist_sq = (x[:, None] - x[None, :])**2 + (y[:, None] - y[None, :])**2
+    return np.count_nonzero(dist_sq < radius**2, axis=1) - 1
+
+def test_neighbour_index_follows_the_radius():
+    rng = np.random.default_rng(2)
+    environment = Environment(GRID)
+    worms = Worms.WormPopulation(WORM_PARAMS, 400, [rng])
+    worms.x, worms.y = rng.uniform(-1.5, 1.5, (2, 1, 400))
+
+    # Same positions, alternating radii: each query gets cells sized for its own radius
+    for radius in (0.05, 0.5, 0.05):
+        counts = worms.neighbour_counts(environment, radius)
+        np.testing.assert_array_equal(counts[0], brute_force_counts(worms.x[0], worms.y[0], radius))
+        assert worms._WormPopulation__neighbour_cells.min_cell_size == radius